@@ -21,39 +21,159 @@ along with this program; if not, write to the Free Software
 Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 """
 
-import os, sys
+import os, sys, heapq, bisect
 from package import *
+from pathname import Pathname
+from index import CatalogIndex
+from discover import DISCOVERY_JOBS
+from timing import timed, begin, end
+
+INDEX_FILE = "~/.homedir/cache/catalog.index"
 
 class MissingPackageError(StandardError): pass
 
-class Catalog:
+class DependencyCycleError(StandardError):
+    "The packages depend on each other in a loop."
+    cycle = None
+    def __init__(self, cycle, *args):
+        self.cycle = cycle
+        StandardError.__init__(self, *args)
+
+    def __str__(self):
+        return "Dependency cycle: %s" % " -> ".join([p.name for p in self.cycle])
+
+class DependencyGraph:
+    """The forward and reverse dependencies of a set of packages.
+
+    The adjacency is worked out once, up front.  Closures and orderings
+    are computed iteratively (so deep graphs can't blow the stack) and
+    are cached by the set of packages asked about.
+    """
+
+    def __init__(self, packages):
+        self.depends  = {}      # package -> packages it depends on
+        self.rdepends = {}      # package -> packages that depend on it
+        self.missing  = {}      # package -> MissingPackageError
+        self._closures = {}
+        self._orders   = {}
+
+        for package in packages:
+            self.depends[package] = set()
+            self.rdepends.setdefault(package, set())
+        for package in packages:
+            try:
+                deps = set(package.depends)
+            except MissingPackageError, err:
+                # Only complain if someone needs this package's dependencies.
+                self.missing[package] = err
+                continue
+            self.depends[package] = deps
+            for dep in deps:
+                self.rdepends.setdefault(dep, set()).add(package)
+
+    def dependencies(self, *packages):
+        "Returns everything the packages depend on, directly or not."
+        return self._closure(self.depends, packages)
+
+    def reverseDependencies(self, *packages):
+        "Returns everything that depends on the packages, directly or not."
+        return self._closure(self.rdepends, packages)
+
+    def _closure(self, edges, packages):
+        key = (edges is self.depends, frozenset(packages))
+        if key not in self._closures:
+            found = set()
+            stack = list(packages)
+            while stack:
+                package = stack.pop()
+                if edges is self.depends and package in self.missing:
+                    raise self.missing[package]
+                for other in edges.get(package, ()):
+                    if other not in found:
+                        found.add(other)
+                        stack.append(other)
+            self._closures[key] = frozenset(found)
+        return set(self._closures[key])
+
+    def topologicalOrder(self, packages, reverse=False):
+        """Returns the packages ordered so dependencies come first.
+
+        Only the dependencies between the given packages are considered.
+        Ties are broken by name so the order is stable.  With reverse,
+        the packages that depend on others come first (removal order).
+
+        Raises DependencyCycleError if the packages depend on each other
+        in a loop.
+        """
+        key = (frozenset(packages), reverse)
+        if key not in self._orders:
+            nodes = key[0]
+            waiting = {}
+            ready = []
+            for package in nodes:
+                waiting[package] = len(self.depends.get(package, set()) & nodes)
+                if not waiting[package]:
+                    ready.append((package.name, id(package), package))
+            heapq.heapify(ready)
+
+            order = []
+            while ready:
+                package = heapq.heappop(ready)[2]
+                order.append(package)
+                for parent in self.rdepends.get(package, ()):
+                    if parent in nodes:
+                        waiting[parent] -= 1
+                        if not waiting[parent]:
+                            heapq.heappush(ready, (parent.name, id(parent), parent))
+
+            if len(order) != len(nodes):
+                raise DependencyCycleError(
+                    self._findCycle([p for p in nodes if waiting[p]]))
+            if reverse:
+                order.reverse()
+            self._orders[key] = tuple(order)
+        return list(self._orders[key])
+
+    def _findCycle(self, stuck):
+        """Returns one dependency cycle among the stuck packages.
+
+        Every stuck package still waits on another stuck package, so
+        following those dependencies must eventually loop.
+        """
+        stuck = set(stuck)
+        byname = lambda p: (p.name, id(p))
+        package = min(stuck, key=byname)
+        path = []
+        seen = {}
+        while package not in seen:
+            seen[package] = len(path)
+            path.append(package)
+            package = min(self.depends[package] & stuck, key=byname)
+        return path[seen[package]:] + [package]
+
+class Catalog(object):
     ##
     # Arguments:
     # * debug -- Turn on debugging in the catalog code.
     # * mock_packages -- A hash of mock packages for testing purposes.
-    def __init__(self, debug=False, mock_packages=None):
-        self.packages = packages = {}
+    # * index_file -- Where to keep the catalog index; None disables it.
+    # * jobs -- How many threads to use when looking for packages.
+    def __init__(self, debug=False, mock_packages=None,
+                 index_file=INDEX_FILE, jobs=DISCOVERY_JOBS):
+        self.packages = {}
         self.debug    = debug
         if mock_packages is not None:
             self.packages = mock_packages
         else:
             top = os.path.expanduser("~/.homedir/packages")
-
-            ## Gather the packages.
-            def walker(arg, dirname, fnames):
-                try:
-                    package = Package(dirname, self)
-                    packages[package.package] = package
-                    while len(fnames) > 0:
-                        del fnames[0]
-                except NotPackageError,err:
-                    for i in range(len(fnames)-1, 0-1, -1):
-                        fname = fnames[i]
-                        if fname.startswith('.'):
-                            del fnames[i]
-
-            os.path.walk(top, walker, None)
-            self.packages = packages
+            if index_file is not None:
+                index_file = os.path.expanduser(index_file)
+            self.index = CatalogIndex(index_file)
+            span = begin('catalog', 'discover packages')
+            try:
+                self.packages = self.index.scan(top, self, jobs)
+            finally:
+                end(span)
 
     def findOne(self, name):
         "Returns one package or None"
@@ -88,20 +208,51 @@ class Catalog:
         "Returns all packages"
         return self.packages.values()
 
+    _graph = None
+    @apply
+    def graph():
+        doc = "The DependencyGraph for all packages, built on first use"
+        def fget(self):
+            if self._graph is None:
+                self._graph = DependencyGraph(self.packages.values())
+            return self._graph
+        return property(**locals())
+
+    _locations = None
+    def owner(self, path):
+        """Returns the package whose location path is in, or None.
+
+        The package locations are kept sorted by their components, so
+        this is a binary search instead of a walk up the filesystem.
+        """
+        if self._locations is None:
+            locations = [(package.package_location._split(), package)
+                         for package in self.packages.values()]
+            locations.sort(key=lambda item: item[0])
+            self._locations = ([parts for parts, package in locations],
+                               [package for parts, package in locations])
+        keys, packages = self._locations
+        root, parts = Pathname(path)._split()
+        # Locations don't nest, so only the one sorted just before path
+        # can hold it.
+        i = bisect.bisect_right(keys, (root, parts)) - 1
+        if i >= 0:
+            location_root, location_parts = keys[i]
+            if location_root == root and \
+               parts[:len(location_parts)] == location_parts:
+                return packages[i]
+        return None
+
+    @timed('deps')
     def findDependencies(self, *packages, **kwargs):
         "Returns all dependencies for the list of packages."
 
         found = kwargs.get('found', set())
         packages = set([self.packages.get(x,x) for x in packages])
-
-        for package in packages:
-            deps = package.depends
-            for dep in deps:
-                found.add(dep)
-                self.findDependencies(dep, found=found)
-
+        found.update(self.graph.dependencies(*packages))
         return found
 
+    @timed('deps')
     def findReverseDependencies(self, *packages, **kwargs):
         """
         Returns all reverse dependencies for the list of packages.
@@ -109,14 +260,7 @@ class Catalog:
 
         found = kwargs.get('found', set())
         packages = set([self.packages.get(x,x) for x in packages])
-
-        for parent in self.packages.values():
-            for dependent in packages:
-                if dependent in parent.depends:
-                    found.add(parent)
-                    # Add all parent packages too.
-                    self.findReverseDependencies(parent, found=found)
-
+        found.update(self.graph.reverseDependencies(*packages))
         return found
 
 if __name__ == "__main__":
@@ -169,6 +313,77 @@ if __name__ == "__main__":
             expected = set([mock_parent, mock_grandparent])
             self.assertEqual(expected, parents, "Expected %r items, got %r" % (expected, parents))
 
+        def test_topologicalOrder(self):
+            # Setup
+            mock_c = self.MockPackage("c")
+            mock_b = self.MockPackage("b", depends_on=[mock_c])
+            mock_a = self.MockPackage("a", depends_on=[mock_b, mock_c])
+            mock_d = self.MockPackage("d")
+            mock_packages = {'a': mock_a, 'b': mock_b, 'c': mock_c, 'd': mock_d}
+            catalog = Catalog(debug=True, mock_packages=mock_packages)
+
+            # Activity
+            order = catalog.graph.topologicalOrder(mock_packages.values())
+            reverse = catalog.graph.topologicalOrder(mock_packages.values(), reverse=True)
+
+            # Verify
+            self.assertEqual([mock_c, mock_b, mock_a, mock_d], order)
+            self.assertEqual([mock_d, mock_a, mock_b, mock_c], reverse)
+
+        def test_cycle(self):
+            # Setup
+            mock_a = self.MockPackage("a")
+            mock_b = self.MockPackage("b", depends_on=[mock_a])
+            mock_c = self.MockPackage("c", depends_on=[mock_b])
+            mock_a.depends = [mock_c]
+            mock_packages = {'a': mock_a, 'b': mock_b, 'c': mock_c}
+            catalog = Catalog(debug=True, mock_packages=mock_packages)
+
+            # Activity / Verify
+            self.assertEqual(set([mock_a, mock_b, mock_c]),
+                             catalog.findDependencies(mock_a))
+            try:
+                catalog.graph.topologicalOrder([mock_a, mock_b, mock_c])
+            except DependencyCycleError, err:
+                self.assertEqual([mock_a, mock_c, mock_b, mock_a], err.cycle)
+            else:
+                self.fail("Expected a DependencyCycleError")
+
+        def test_owner(self):
+            # Setup
+            mock_packages = {}
+            for name in ('a', 'a-b', 'b', 'c'):
+                mock_packages[name] = self.MockPackage(name)
+                mock_packages[name].package_location = Pathname(os.sep, 'pkgs', name)
+            catalog = Catalog(debug=True, mock_packages=mock_packages)
+
+            # Activity / Verify
+            for name in ('a', 'a-b', 'c'):
+                self.assertEqual(mock_packages[name],
+                                 catalog.owner(Pathname(os.sep, 'pkgs', name, 'x', 'y')))
+            self.assertEqual(mock_packages['a'], catalog.owner(os.sep + 'pkgs/a'))
+            self.assertEqual(None, catalog.owner(os.sep + 'pkgs/ab/x'))
+            self.assertEqual(None, catalog.owner(os.sep + 'pkgs'))
+            self.assertEqual(None, catalog.owner(os.sep + 'elsewhere'))
+
+        def test_deepGraph(self):
+            # Setup
+            chain = [self.MockPackage("p%04d" % 0)]
+            for i in range(1, 2000):
+                chain.append(self.MockPackage("p%04d" % i, depends_on=[chain[-1]]))
+            mock_packages = dict([(p.name, p) for p in chain])
+            catalog = Catalog(debug=True, mock_packages=mock_packages)
+
+            # Activity
+            deps = catalog.findDependencies(chain[-1])
+            rdeps = catalog.findReverseDependencies(chain[0])
+            order = catalog.graph.topologicalOrder(chain)
+
+            # Verify
+            self.assertEqual(set(chain[:-1]), deps)
+            self.assertEqual(set(chain[1:]), rdeps)
+            self.assertEqual(chain, order)
+
     unittest.main()
 #    cat = Catalog()
 #    pkgs = cat.packages.values()
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+This is a package management system designed to work around packages
+for the homedirectory.  The code is based upon ideas from GNU Stow.
+
+HomeDir - manage the installation of packages for a user's homedir
+Copyright (C) 2004-2012 by Christian Höltje
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+"""
+
+import os, sys
+from pathname import Pathname, forget_stats, temporary_name
+
+__all__ = ( 'DirFdOperations', 'PathOperations', 'operations' )
+
+# Python 2 has no dir_fd= arguments, so the *at() calls come from libc
+# through ctypes.  Fallback to plain paths if they aren't there.
+AT_REMOVEDIR = { 'linux':  0x200,
+                 'darwin': 0x80 }.get(sys.platform.rstrip('0123456789'))
+try:
+    import ctypes, ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _symlinkat  = _libc.symlinkat
+    _unlinkat   = _libc.unlinkat
+    _mkdirat    = _libc.mkdirat
+    _renameat   = _libc.renameat
+    _readlinkat = _libc.readlinkat
+    _readlinkat.restype = ctypes.c_ssize_t
+except (ImportError, OSError, AttributeError, TypeError):
+    _libc = None
+
+O_DIRECTORY = getattr(os, 'O_DIRECTORY', 0)
+O_NOFOLLOW  = getattr(os, 'O_NOFOLLOW', 0)
+ENCODING = sys.getfilesystemencoding() or 'utf-8'
+PATH_MAX = 4096
+
+def _encode(name):
+    if isinstance(name, unicode):
+        return name.encode(ENCODING)
+    return str(name)
+
+def _check(result, path):
+    if result < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), path)
+    return result
+
+class PathOperations:
+    "Changes the filesystem by full path names, through Pathname"
+
+    def mkdir(self, path):
+        Pathname(path).mkdir()
+
+    def symlink(self, target, path):
+        Pathname(target).symlink(path)
+
+    def relink(self, target, path):
+        Pathname(target).relink(path)
+
+    def unlink(self, path):
+        Pathname(path).unlink()
+
+    def rmdir(self, path):
+        Pathname(path).rmdir()
+
+    def rename(self, path, dest):
+        Pathname(path).rename(dest)
+
+    def readlink(self, path):
+        return Pathname(path).readlink()
+
+    def close(self):
+        pass
+
+class DirFdOperations:
+    """Changes the filesystem relative to directory file descriptors
+
+    Each directory is opened once, the first time something in it is
+    changed, and the name is then looked up in that directory only.  It
+    saves walking the whole path for every change, and a directory that
+    is swapped for something else half way through is not followed.
+    """
+
+    def __init__(self):
+        self._fds = {}
+
+    def _at(self, path):
+        "Returns (fd of the parent, name) for path"
+        parent, name = os.path.split(unicode(path))
+        fd = self._fds.get(parent)
+        if fd is None:
+            fd = os.open(_encode(parent), os.O_RDONLY | O_DIRECTORY | O_NOFOLLOW)
+            self._fds[parent] = fd
+        return fd, _encode(name)
+
+    def _forget(self, path):
+        "Closes the directories at or below path; they've gone or moved"
+        path = unicode(path)
+        prefix = path + os.sep
+        for directory in self._fds.keys():
+            if directory == path or directory.startswith(prefix):
+                os.close(self._fds.pop(directory))
+
+    def mkdir(self, path):
+        fd, name = self._at(path)
+        try:
+            _check(_mkdirat(fd, name, 0777), path)
+        finally:
+            forget_stats()
+
+    def symlink(self, target, path):
+        fd, name = self._at(path)
+        try:
+            _check(_symlinkat(_encode(target), fd, name), path)
+        finally:
+            forget_stats()
+
+    def relink(self, target, path):
+        fd, name = self._at(path)
+        tmp = _encode(os.path.basename(temporary_name(unicode(path))))
+        try:
+            _check(_symlinkat(_encode(target), fd, tmp), path)
+            if _renameat(fd, tmp, fd, name) < 0:
+                err = ctypes.get_errno()
+                _unlinkat(fd, tmp, 0)
+                raise OSError(err, os.strerror(err), path)
+        finally:
+            forget_stats()
+
+    def unlink(self, path):
+        fd, name = self._at(path)
+        try:
+            _check(_unlinkat(fd, name, 0), path)
+        finally:
+            forget_stats()
+
+    def rmdir(self, path):
+        fd, name = self._at(path)
+        try:
+            _check(_unlinkat(fd, name, AT_REMOVEDIR), path)
+        finally:
+            self._forget(path)
+            forget_stats()
+
+    def rename(self, path, dest):
+        fd, name = self._at(path)
+        dest_fd, dest_name = self._at(dest)
+        try:
+            _check(_renameat(fd, name, dest_fd, dest_name), path)
+        finally:
+            self._forget(path)
+            forget_stats()
+
+    def readlink(self, path):
+        fd, name = self._at(path)
+        buf = ctypes.create_string_buffer(PATH_MAX)
+        size = _check(_readlinkat(fd, name, buf, PATH_MAX), path)
+        return Pathname(buf.raw[:size].decode(ENCODING))
+
+    def close(self):
+        for fd in self._fds.values():
+            os.close(fd)
+        self._fds = {}
+
+def operations():
+    "Returns DirFdOperations where the platform has them, else PathOperations"
+    if _libc is None or AT_REMOVEDIR is None:
+        return PathOperations()
+    return DirFdOperations()
+
+if __name__ == "__main__":
+    import unittest, tempfile
+
+    class OperationsTestCase(unittest.TestCase):
+
+        def setUp(self):
+            self.tmp = Pathname(tempfile.mkdtemp()).realpath()
+
+        def tearDown(self):
+            self.tmp.rm_rf()
+
+        def exercise(self, ops):
+            try:
+                d = self.tmp + 'dir'
+                ops.mkdir(d)
+                ops.symlink('target', d + 'link')
+                self.assertEqual(Pathname('target'), ops.readlink(d + 'link'))
+                ops.relink('other', d + 'link')
+                self.assertEqual(Pathname('other'), ops.readlink(d + 'link'))
+                self.assertEqual([Pathname('link')], list(d.listdir()))
+                ops.rename(d + 'link', self.tmp + 'moved')
+                self.assertTrue((self.tmp + 'moved').islink())
+                ops.unlink(self.tmp + 'moved')
+                ops.rmdir(d)
+                self.assertEqual((), self.tmp.listdir())
+                # It's a new directory now.
+                ops.mkdir(d)
+                ops.symlink('target', d + 'link')
+                self.assertTrue((d + 'link').islink())
+                self.assertRaises(OSError, ops.mkdir, d)
+            finally:
+                ops.close()
+
+        def testPathOperations(self):
+            self.exercise(PathOperations())
+
+        def testOperations(self):
+            self.exercise(operations())
+
+    unittest.main()
+
+# vim: set sw=4 ts=4 expandtab
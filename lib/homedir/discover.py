@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+This is a package management system designed to work around packages
+for the homedirectory.  The code is based upon ideas from GNU Stow.
+
+HomeDir - manage the installation of packages for a user's homedir
+Copyright (C) 2004-2012 by Christian Höltje
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+"""
+
+import os, stat
+from package import CONTROLDIR, CONTROLFILENAME, OLD_CONTROLFILENAME
+from pool import parallel_map
+
+# scandir gives us the file type from the directory listing itself
+# (d_type), saving an lstat per entry.  Fallback to listdir.
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+__all__ = ( 'scan_dir', 'subdirectories', 'walk', 'DISCOVERY_JOBS' )
+
+DISCOVERY_JOBS = 8
+
+def _lstat_isdir(path):
+    try:
+        return stat.S_ISDIR(os.lstat(path).st_mode)
+    except OSError:
+        return False
+
+def _entries(dirname):
+    """Lists dirname once.
+
+    Returns (names, isdir, isfile) where isdir(name) is true for real
+    (non-symlink) directories and isfile(name) follows symlinks.
+    """
+    if scandir is not None:
+        entries = {}
+        for entry in scandir(dirname):
+            entries[entry.name] = entry
+        names = sorted(entries.keys())
+        isdir = lambda name: entries[name].is_dir(follow_symlinks=False)
+        isfile = lambda name: entries[name].is_file()
+    else:
+        names = sorted(os.listdir(dirname))
+        isdir = lambda name: _lstat_isdir(os.path.join(dirname, name))
+        isfile = lambda name: os.path.isfile(os.path.join(dirname, name))
+    return names, isdir, isfile
+
+def scan_dir(dirname):
+    """Looks at dirname with a single directory listing.
+
+    Returns (control, subdirs).  If dirname is a package then control is
+    the path to its control file and subdirs is empty; otherwise control
+    is None and subdirs are the names of the non-hidden sub-directories.
+    """
+    names, isdir, isfile = _entries(dirname)
+    if CONTROLDIR in names:
+        control = os.path.join(dirname, CONTROLDIR, CONTROLFILENAME)
+        if os.path.isfile(control):
+            return control, ()
+    if OLD_CONTROLFILENAME in names and isfile(OLD_CONTROLFILENAME):
+        return os.path.join(dirname, OLD_CONTROLFILENAME), ()
+    return None, tuple([name for name in names
+                        if not name.startswith('.') and isdir(name)])
+
+def subdirectories(dirname):
+    "Returns the names of the non-hidden sub-directories of dirname"
+    names, isdir, isfile = _entries(dirname)
+    return tuple([name for name in names
+                  if not name.startswith('.') and isdir(name)])
+
+def walk(top, visit, jobs=DISCOVERY_JOBS):
+    """Walks the packages tree below top.
+
+    visit(dirname) is called for top and each directory below it and
+    returns the names of the sub-directories to descend into; returning
+    nothing prunes the subtree.  The subtrees of top's sub-directories
+    are shared out over up to jobs threads, so visit must be thread-safe.
+    """
+    def descend(dirname):
+        for name in visit(dirname):
+            descend(os.path.join(dirname, name))
+
+    roots = [os.path.join(top, name) for name in visit(top)]
+    parallel_map(descend, roots, jobs)
+
+# vim: set sw=4 ts=4 expandtab
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+This is a package management system designed to work around packages
+for the homedirectory.  The code is based upon ideas from GNU Stow.
+
+HomeDir - manage the installation of packages for a user's homedir
+Copyright (C) 2004-2012 by Christian Höltje
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+"""
+
+import threading, time
+try:
+    import json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        json = None
+
+__all__ = ( 'EventStream', 'start_events', 'stop_events', 'emitting', 'emit' )
+
+class EventStream:
+    """Writes events as newline-delimited JSON, one object per line.
+
+    Every event has an "event" kind and the "time" (seconds since the
+    epoch) it happened; the rest depends on the kind.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._lock = threading.Lock()
+
+    def emit(self, event, **fields):
+        fields['event'] = event
+        fields['time'] = time.time()
+        line = json.dumps(fields, sort_keys=True)
+        self._lock.acquire()
+        try:
+            self.stream.write(line + "\n")
+            self.stream.flush()
+        finally:
+            self._lock.release()
+
+_events = None
+
+def start_events(stream):
+    "Starts writing events to stream, returning the EventStream"
+    global _events
+    _events = EventStream(stream)
+    return _events
+
+def stop_events():
+    global _events
+    _events = None
+
+def emitting():
+    "Returns True if events are being written"
+    return _events is not None
+
+def emit(event, **fields):
+    "Writes an event, if events are being written"
+    if _events is not None:
+        _events.emit(event, **fields)
+
+if __name__ == "__main__":
+    import unittest
+    from StringIO import StringIO
+
+    class EventsTestCase(unittest.TestCase):
+
+        def tearDown(self):
+            stop_events()
+
+        def testStream(self):
+            emit('ignored')
+            self.assertFalse(emitting())
+            if json is None:
+                return
+            out = StringIO()
+            start_events(out)
+            emit('package-start', package='vim', action='installing')
+            emit('phase', phase='installing')
+            lines = out.getvalue().splitlines()
+            self.assertEqual(2, len(lines))
+            first = json.loads(lines[0])
+            self.assertEqual('package-start', first['event'])
+            self.assertEqual('vim', first['package'])
+            self.assertTrue(first['time'] > 0)
+
+    unittest.main()
+
+# vim: set sw=4 ts=4 expandtab
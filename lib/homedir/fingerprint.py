@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+This is a package management system designed to work around packages
+for the homedirectory.  The code is based upon ideas from GNU Stow.
+
+HomeDir - manage the installation of packages for a user's homedir
+Copyright (C) 2004-2012 by Christian Höltje
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+"""
+
+import os, stat, tempfile
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+from pathname import Pathname
+from handle import warn, ensure_dir
+
+__all__ = ( 'Fingerprint', 'FingerprintStore', 'FINGERPRINT_DIR' )
+
+# Where the fingerprints live, relative to the destination directory.
+FINGERPRINT_DIR = os.path.join('.homedir', 'fingerprints')
+FINGERPRINT_VERSION = 1
+BLOCKSIZE = 65536
+
+def _encode(path):
+    return unicode(path).encode('utf-8')
+
+class Fingerprint:
+    """What a package's tree looks like, to tell whether it has changed.
+
+    quick() digests the name, mode, size and mtime of everything in the
+    tree, which only takes a walk over it.  content() digests the names,
+    modes, link texts and file contents; it's only worked out when asked.
+    """
+
+    def __init__(self, location, ignore=()):
+        self.location = Pathname(location)
+        self.ignore = ignore
+        self._entries = None
+        self._quick = None
+        self._content = None
+
+    def _walk(self):
+        "Returns the (relative path, lstat) of everything in the tree, sorted"
+        if self._entries is None:
+            entries = []
+            pending = [(self.location, u'')]
+            while pending:
+                directory, prefix = pending.pop()
+                for entry in directory.scandir():
+                    name = unicode(entry.name)
+                    if name in self.ignore:
+                        continue
+                    relpath = prefix + name
+                    st = entry.lstat()
+                    entries.append((relpath, st))
+                    if stat.S_ISDIR(st.st_mode):
+                        pending.append((entry.path, relpath + os.sep))
+            entries.sort()
+            self._entries = entries
+        return self._entries
+
+    def quick(self):
+        if self._quick is None:
+            digest = sha1()
+            for relpath, st in self._walk():
+                digest.update("%s\0%o\0%d\0%r\n" % (_encode(relpath), st.st_mode,
+                                                     st.st_size, st.st_mtime))
+            self._quick = digest.hexdigest()
+        return self._quick
+
+    def content(self):
+        if self._content is None:
+            digest = sha1()
+            for relpath, st in self._walk():
+                digest.update("%s\0%o\0" % (_encode(relpath), st.st_mode))
+                path = self.location + relpath
+                if stat.S_ISLNK(st.st_mode):
+                    digest.update(_encode(path.readlink()))
+                elif stat.S_ISREG(st.st_mode):
+                    fp = file(str(path), 'rb')
+                    try:
+                        block = fp.read(BLOCKSIZE)
+                        while block:
+                            digest.update(block)
+                            block = fp.read(BLOCKSIZE)
+                    finally:
+                        fp.close()
+                digest.update("\n")
+            self._content = digest.hexdigest()
+        return self._content
+
+class FingerprintStore:
+    """The fingerprints of packages' trees from when their hooks last all
+    succeeded, for one destination directory.
+
+    Each package has a file of its own holding the quick and the content
+    digests.
+    """
+
+    def __init__(self, dest):
+        self.directory = os.path.join(os.path.realpath(unicode(dest)), FINGERPRINT_DIR)
+
+    def _filename(self, name):
+        return os.path.join(self.directory, name)
+
+    def get(self, name):
+        "Returns the recorded (quick, content) digests for name, or None"
+        try:
+            fp = file(self._filename(name), 'r')
+        except IOError:
+            return None
+        try:
+            lines = fp.read().split('\n')
+        finally:
+            fp.close()
+        if lines[0].split()[-1:] != [str(FINGERPRINT_VERSION)]:
+            return None
+        if len(lines) < 2:
+            return None
+        parts = lines[1].split('\t')
+        if len(parts) != 2:
+            return None
+        return tuple(parts)
+
+    def unchanged(self, name, fingerprint):
+        """Returns True if fingerprint matches the one recorded for name
+
+        The quick digests are compared first and the contents only if
+        they differ, e.g. because the files were touched.
+        """
+        recorded = self.get(name)
+        if recorded is None:
+            return False
+        quick, content = recorded
+        if quick == fingerprint.quick():
+            return True
+        if content == fingerprint.content():
+            # Save working the content out again next time.
+            self.record(name, fingerprint)
+            return True
+        return False
+
+    def record(self, name, fingerprint):
+        "Records fingerprint for name (atomically)"
+        try:
+            ensure_dir(self.directory)
+            fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+            fp = os.fdopen(fd, 'w')
+            try:
+                fp.write("# homedir fingerprint %d\n" % FINGERPRINT_VERSION)
+                fp.write("%s\t%s\n" % (fingerprint.quick(), fingerprint.content()))
+            finally:
+                fp.close()
+            os.rename(tmp, self._filename(name))
+        except (IOError, OSError), err:
+            warn("Unable to write the fingerprint of %s: %s" % (name, err))
+
+    def forget(self, name):
+        try:
+            os.unlink(self._filename(name))
+        except OSError:
+            pass
+
+if __name__ == "__main__":
+    import unittest, shutil, time
+
+    class FingerprintTestCase(unittest.TestCase):
+
+        def setUp(self):
+            self.tmp = os.path.realpath(tempfile.mkdtemp())
+            self.pkg = os.path.join(self.tmp, 'pkg')
+            os.makedirs(os.path.join(self.pkg, 'bin'))
+            os.makedirs(os.path.join(self.pkg, '.git'))
+            self.write('bin/tool', 'one')
+            os.symlink('bin/tool', os.path.join(self.pkg, 'link'))
+
+        def tearDown(self):
+            shutil.rmtree(self.tmp)
+
+        def write(self, relpath, text, mtime=None):
+            path = os.path.join(self.pkg, relpath)
+            fp = file(path, 'w')
+            try:
+                fp.write(text)
+            finally:
+                fp.close()
+            if mtime is not None:
+                os.utime(path, (mtime, mtime))
+
+        def fingerprint(self):
+            return Fingerprint(self.pkg, ignore=('.git',))
+
+        def testChanges(self):
+            first = self.fingerprint()
+            self.assertEqual(first.quick(), self.fingerprint().quick())
+            self.write('.git/HEAD', 'ignored')
+            self.assertEqual(first.quick(), self.fingerprint().quick())
+
+            # Touched, but the same.
+            self.write('bin/tool', 'one', time.time() + 10)
+            touched = self.fingerprint()
+            self.assertNotEqual(first.quick(), touched.quick())
+            self.assertEqual(first.content(), touched.content())
+
+            # Same size and time, different content.
+            self.write('bin/tool', 'two', time.time() + 10)
+            self.assertNotEqual(first.content(), self.fingerprint().content())
+
+        def testStore(self):
+            store = FingerprintStore(self.tmp)
+            self.assertEqual(None, store.get('pkg'))
+            self.assertFalse(store.unchanged('pkg', self.fingerprint()))
+            store.record('pkg', self.fingerprint())
+            self.assertTrue(store.unchanged('pkg', self.fingerprint()))
+
+            self.write('bin/tool', 'one', time.time() + 10)
+            self.assertTrue(store.unchanged('pkg', self.fingerprint()))
+            # That recorded the new quick digest.
+            self.assertEqual(self.fingerprint().quick(), store.get('pkg')[0])
+
+            self.write('bin/tool', 'three')
+            self.assertFalse(store.unchanged('pkg', self.fingerprint()))
+            store.forget('pkg')
+            self.assertEqual(None, store.get('pkg'))
+
+    unittest.main()
+
+# vim: set sw=4 ts=4 expandtab
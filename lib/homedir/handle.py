@@ -21,7 +21,9 @@ along with this program; if not, write to the Free Software
 Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 """
 
-__all__ = ( 'warn_mode', 'warn', 'pluralize' )
+import os, errno
+
+__all__ = ( 'warn_mode', 'warn', 'pluralize', 'ensure_dir' )
 
 # Warn mode helper
 WARN = False
@@ -35,6 +37,20 @@ def warn(*msg):
     if WARN:
         print "WARN: %s" % " ".join(map(str,msg))
 
+def ensure_dir(directory):
+    """Makes directory (and its parents) unless it's there already
+
+    Something else running at the same time may make it first; that's
+    fine too.
+    """
+    if os.path.isdir(directory):
+        return
+    try:
+        os.makedirs(directory)
+    except OSError, err:
+        if err.errno != errno.EEXIST:
+            raise
+
 def pluralize(singular,plural,count):
     "Returns the correct form of a word, based on count"
     if count == 1:
@@ -0,0 +1,402 @@
+# -*- coding: utf-8 -*-
+"""
+This is a package management system designed to work around packages
+for the homedirectory.  The code is based upon ideas from GNU Stow.
+
+HomeDir - manage the installation of packages for a user's homedir
+Copyright (C) 2004-2012 by Christian Höltje
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+"""
+
+import os, sys, errno, signal, subprocess, tempfile, threading, time
+from timeit import default_timer as timer
+from timing import begin, end
+from events import emit
+
+__all__ = ( 'HookError', 'HookResult', 'HookRunner', 'run_hook' )
+
+class HookError(StandardError):
+    "A package's hook failed."
+    result = None
+    def __init__(self, result, *args):
+        self.result = result
+        StandardError.__init__(self, *args)
+
+    def __str__(self):
+        return str(self.result)
+
+class HookResult:
+    "How running one hook went"
+
+    def __init__(self, package, name, path):
+        self.package = package  # the package's name
+        self.name = name        # e.g. post-install
+        self.dest = None        # where the package was being installed (real path)
+        self.path = path
+        self.returncode = None
+        self.timed_out = False
+        self.error = None       # why it couldn't be started
+        self.duration = 0.0
+        self.stdout = ''
+        self.stderr = ''
+
+    def ok(self):
+        return self.returncode == 0 and not self.timed_out
+
+    def __str__(self):
+        if self.error is not None:
+            status = "could not be run: %s" % self.error
+        elif self.timed_out:
+            status = "timed out after %.1fs" % self.duration
+        elif self.returncode < 0:
+            status = "was killed by signal %d after %.1fs" % (-self.returncode, self.duration)
+        else:
+            status = "exited with %d after %.1fs" % (self.returncode, self.duration)
+        return "%s for %s %s" % (self.name, self.package, status)
+
+    def output(self):
+        "Returns the captured output, as lines"
+        return (self.stdout + self.stderr).splitlines()
+
+def _start(path, stdin, stdout, stderr, env):
+    "Starts the hook at path in a session of its own"
+    try:
+        return subprocess.Popen([path], stdin=stdin, env=env,
+                                stdout=stdout, stderr=stderr,
+                                close_fds=True, preexec_fn=os.setsid)
+    except OSError, err:
+        if err.errno != errno.ENOEXEC:
+            raise
+    # No #! line; run it with sh, as execvp() (and os.system) would.
+    return subprocess.Popen(['/bin/sh', path], stdin=stdin, env=env,
+                            stdout=stdout, stderr=stderr,
+                            close_fds=True, preexec_fn=os.setsid)
+
+def _wait(process, timeout):
+    """Waits for process to exit, for up to timeout seconds
+
+    Returns False if it was still running then; it and everything in
+    its process group have been killed.
+    """
+    if not timeout:
+        process.wait()
+        return True
+    deadline = timer() + timeout
+    delay = 0.001
+    while process.poll() is None:
+        left = deadline - timer()
+        if left <= 0:
+            # It's still running, so its process group is its own.
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            process.wait()
+            return False
+        time.sleep(min(delay, left))
+        delay = min(delay * 2, 0.05)
+    return True
+
+def _read(fp):
+    if fp is None:
+        return ''
+    fp.seek(0)
+    return fp.read()
+
+def run_hook(path, package=None, name=None, timeout=None, stdin=None, env=None,
+             capture=True):
+    """Runs the hook at path (without a shell) and returns a HookResult
+
+    The hook gets a process group of its own, so that if it takes more
+    than timeout seconds it can be killed along with anything it started.
+    Only the hook itself is waited for: what it leaves running in the
+    background is left alone.  That's why the output is kept in temporary
+    files rather than pipes, which stay open as long as anything has them.
+
+    With capture unset, the output goes wherever ours does.
+    """
+    if name is None:
+        name = os.path.basename(path)
+    result = HookResult(package, name, path)
+    stdout = stderr = None
+    if capture:
+        stdout = tempfile.TemporaryFile()
+        stderr = tempfile.TemporaryFile()
+    try:
+        start = timer()
+        try:
+            process = _start(path, stdin, stdout, stderr, env)
+        except OSError, err:
+            result.error = err.strerror or str(err)
+            return result
+        result.timed_out = not _wait(process, timeout)
+        result.returncode = process.returncode
+        result.duration = timer() - start
+        result.stdout = _read(stdout)
+        result.stderr = _read(stderr)
+    finally:
+        if capture:
+            stdout.close()
+            stderr.close()
+    return result
+
+class HookRunner:
+    """Runs packages' hooks, keeping what happened.
+
+    run() runs a hook straight away and submit() runs it in the
+    background on up to jobs threads; either waits for the background
+    hooks of the packages given as after.  wait() waits for them all.
+
+    Results pile up per package until taken with take().
+
+    The same package can be installed into several destinations at once;
+    they're told apart by the dest passed in (by its real path, so
+    ~/ and ~ are the same), which the hooks also get as their $HOME.
+    """
+
+    def __init__(self, jobs=1, timeout=None):
+        self.jobs = jobs
+        self.timeout = timeout
+        self._slots = threading.Semaphore(max(jobs, 1))
+        self._lock = threading.Lock()
+        self._done = {}         # (package name, dest) -> [Event] set once its hooks are done
+        self._threads = []
+        self._results = {}      # (package name, dest) -> [HookResult]
+        self.failed = []
+
+    def _record(self, result):
+        emit('hook', package=result.package, hook=result.name, ok=result.ok(),
+             returncode=result.returncode, timed_out=result.timed_out,
+             error=result.error, duration=result.duration)
+        self._lock.acquire()
+        try:
+            self._results.setdefault((result.package, result.dest), []).append(result)
+            if not result.ok():
+                self.failed.append(result)
+        finally:
+            self._lock.release()
+
+    def _dest(self, dest):
+        "Returns the form of dest the results are kept under"
+        if dest is None:
+            return None
+        return os.path.realpath(unicode(dest))
+
+    def _waits(self, after, dest):
+        "Returns the events to wait for before the hooks of packages after"
+        waits = []
+        for other in after:
+            waits.extend(self._done.get((other.package, dest), ()))
+        return waits
+
+    def run(self, package, name, path, stdin=None, after=(), dest=None, capture=None):
+        """Runs one of package's hooks now and returns the HookResult
+
+        It waits for the background hooks of the packages in after first.
+        Its output is only captured if capture is set or, by default, if
+        our output isn't a terminal; a hook may want to ask something.
+        """
+        if capture is None:
+            capture = not sys.stdout.isatty()
+        dest = self._dest(dest)
+        for event in self._waits(after, dest):
+            event.wait()
+        env = None
+        if dest is not None:
+            env = dict(os.environ)
+            env['HOME'] = unicode(dest).encode(sys.getfilesystemencoding() or 'utf-8')
+        span = begin('hook', "%s %s" % (name, package.package), package.package)
+        try:
+            result = run_hook(path, package.package, name, self.timeout, stdin, env,
+                              capture)
+        finally:
+            end(span)
+        result.dest = dest
+        self._record(result)
+        return result
+
+    def submit(self, package, name, path, after=(), succeeded=None, dest=None):
+        """Runs one of package's hooks in the background (see the class doc)
+
+        With path None there's no hook to run, but whatever waits for
+        package still waits for the hooks of the packages in after.
+        succeeded, if given, is called (in the background) if it works.
+        """
+        dest = self._dest(dest)
+        key = (package.package, dest)
+        self._lock.acquire()
+        try:
+            waits = self._waits(after, dest)
+            if path is None:
+                self._done[key] = waits
+                return
+            done = threading.Event()
+            self._done[key] = [done]
+        finally:
+            self._lock.release()
+
+        def work():
+            try:
+                for event in waits:
+                    event.wait()
+                self._slots.acquire()
+                try:
+                    devnull = file(os.devnull, 'r')
+                    try:
+                        result = self.run(package, name, path, stdin=devnull, dest=dest,
+                                          capture=True)
+                    finally:
+                        devnull.close()
+                    if result.ok() and succeeded is not None:
+                        succeeded()
+                finally:
+                    self._slots.release()
+            finally:
+                done.set()
+
+        thread = threading.Thread(target=work, name="%s %s" % (name, package.package))
+        thread.setDaemon(True)
+        thread.start()
+        self._threads.append(thread)
+
+    def pending(self):
+        "Returns how many background hooks haven't finished"
+        return len([thread for thread in self._threads if thread.isAlive()])
+
+    def wait(self):
+        "Waits for every background hook to finish"
+        for thread in self._threads:
+            # A timeout keeps Ctrl-C working while we wait.
+            while thread.isAlive():
+                thread.join(0.1)
+        self._threads = []
+
+    def take(self, package=None, dest=None):
+        """Returns (and forgets) the results for package (in dest), or for
+        every package.
+
+        They're in the order the hooks finished.
+        """
+        self._lock.acquire()
+        try:
+            if package is None:
+                results = []
+                for value in self._results.values():
+                    results.extend(value)
+                self._results = {}
+                return results
+            return self._results.pop((package.package, self._dest(dest)), [])
+        finally:
+            self._lock.release()
+
+if __name__ == "__main__":
+    import unittest, tempfile, shutil
+
+    class MockPackage:
+        def __init__(self, package):
+            self.package = package
+
+    class HookTestCase(unittest.TestCase):
+
+        def setUp(self):
+            self.tmp = tempfile.mkdtemp()
+
+        def tearDown(self):
+            shutil.rmtree(self.tmp)
+
+        def hook(self, name, script):
+            path = os.path.join(self.tmp, name)
+            fp = file(path, 'w')
+            try:
+                fp.write("#!/bin/sh\n" + script + "\n")
+            finally:
+                fp.close()
+            os.chmod(path, 0755)
+            return path
+
+        def testOutputAndStatus(self):
+            result = run_hook(self.hook('post-install', 'echo out; echo err >&2; exit 3'),
+                              'pkg')
+            self.assertEqual(3, result.returncode)
+            self.assertFalse(result.ok())
+            self.assertEqual(['out', 'err'], result.output())
+            self.assertEqual('post-install', result.name)
+
+        def testTimeout(self):
+            result = run_hook(self.hook('slow', 'sleep 5 & sleep 5'), timeout=0.2)
+            self.assertTrue(result.timed_out)
+            self.assertTrue(result.duration < 4)
+
+        def testBackgroundChild(self):
+            result = run_hook(self.hook('daemon', 'sleep 5 & echo $!'), timeout=0.5)
+            self.assertTrue(result.ok())
+            self.assertTrue(result.duration < 0.5)
+            # It was left running.
+            child = int(result.output()[0])
+            os.kill(child, signal.SIGKILL)
+
+        def testNoShebang(self):
+            path = os.path.join(self.tmp, 'post-install')
+            fp = file(path, 'w')
+            try:
+                fp.write("echo hi\n")
+            finally:
+                fp.close()
+            os.chmod(path, 0755)
+            result = run_hook(path)
+            self.assertTrue(result.ok())
+            self.assertEqual(['hi'], result.output())
+
+        def testNotRunnable(self):
+            path = os.path.join(self.tmp, 'missing')
+            self.assertFalse(run_hook(path).ok())
+
+        def testBackgroundOrder(self):
+            log = os.path.join(self.tmp, 'log')
+            runner = HookRunner(jobs=4)
+            a, b, c, d = [MockPackage(name) for name in 'abcd']
+            runner.submit(a, 'post-install', self.hook('a', 'sleep 0.3; echo a >> %s' % log))
+            runner.submit(b, 'post-install', None, after=[a])
+            runner.submit(d, 'post-install', self.hook('d', 'echo d >> %s' % log), after=[b])
+            runner.submit(c, 'post-install', self.hook('c', 'exit 1'))
+            runner.wait()
+            self.assertEqual("a\nd\n", file(log).read())
+            self.assertEqual(['c'], [r.package for r in runner.failed])
+            self.assertEqual(3, len(runner.take()))
+            self.assertEqual([], runner.take(a))
+
+        def testTargets(self):
+            runner = HookRunner(jobs=2)
+            a = MockPackage('a')
+            hook = self.hook('a', 'echo $HOME')
+            for dest in ('/one', '/two'):
+                runner.submit(a, 'post-install', hook, dest=dest)
+            runner.wait()
+            self.assertEqual(['/one'], runner.take(a, '/one')[0].output())
+            self.assertEqual('/two', runner.take(a, '/two')[0].dest)
+
+        def testForegroundTakenOnce(self):
+            runner = HookRunner()
+            a = MockPackage('a')
+            result = runner.run(a, 'pre-install', self.hook('a', 'exit 3'),
+                                dest=self.tmp + os.sep)
+            self.assertFalse(result.ok())
+            self.assertEqual([result], runner.take(a, self.tmp))
+            self.assertEqual([], runner.take())
+
+    unittest.main()
+
+# vim: set sw=4 ts=4 expandtab
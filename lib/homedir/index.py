@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+This is a package management system designed to work around packages
+for the homedirectory.  The code is based upon ideas from GNU Stow.
+
+HomeDir - manage the installation of packages for a user's homedir
+Copyright (C) 2004-2012 by Christian Höltje
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+"""
+
+import os, sys, threading
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+from handle import warn, ensure_dir
+from package import *
+from discover import scan_dir, subdirectories, walk
+
+__all__ = ( 'CatalogIndex', 'INDEX_VERSION' )
+
+INDEX_VERSION = 2
+
+def signature(path):
+    "Returns a cheap (mtime, size, inode) signature for path or None"
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size, st.st_ino)
+
+class CatalogIndex:
+    """An on-disk index of the packages tree.
+
+    The index remembers the control file header of every package and the
+    sub-directories of every non-package directory, along with a stat
+    signature for each.  Scanning with a warm index only needs to stat
+    the directories and control files; anything whose signature changed
+    is re-read and re-parsed.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.dirs = {}
+        self.packages = {}
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        "Loads the index from disk, starting empty if it's missing or stale."
+        if self.filename is None or not os.path.isfile(self.filename):
+            return
+        try:
+            fp = file(self.filename, 'rb')
+            try:
+                data = pickle.load(fp)
+            finally:
+                fp.close()
+        except StandardError, err:
+            warn("Ignoring unreadable catalog index %s: %s" % (self.filename, err))
+            return
+        if not isinstance(data, dict) or data.get('version') != INDEX_VERSION:
+            return
+        self.dirs = data['dirs']
+        self.packages = data['packages']
+
+    def save(self):
+        "Writes the index to disk (atomically)."
+        if self.filename is None:
+            return
+        data = {'version':  INDEX_VERSION,
+                'dirs':     self.dirs,
+                'packages': self.packages}
+        tmp = "%s.%d.tmp" % (self.filename, os.getpid())
+        try:
+            ensure_dir(os.path.dirname(self.filename))
+            fp = file(tmp, 'wb')
+            try:
+                pickle.dump(data, fp, pickle.HIGHEST_PROTOCOL)
+            finally:
+                fp.close()
+            os.rename(tmp, self.filename)
+        except (IOError, OSError), err:
+            warn("Unable to write catalog index %s: %s" % (self.filename, err))
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+    def scan(self, top, catalog, jobs=1):
+        """Finds all the packages below top.
+
+        Returns a dictionary of package name to Package. The index is
+        updated in memory and saved if anything changed.
+        """
+        old_dirs, old_packages = self.dirs, self.packages
+        self.dirs, self.packages = {}, {}
+        self.hits = self.misses = 0
+        found = {}
+
+        def visit(dirname):
+            subdirs = self._cachedDir(dirname, old_dirs.get(dirname))
+            if subdirs is not None:
+                return subdirs
+            package = self._cachedPackage(dirname, old_packages.get(dirname), catalog)
+            if package is None:
+                try:
+                    control, subdirs = scan_dir(dirname)
+                    if control is not None:
+                        package = self._parsePackage(dirname, control, catalog)
+                        if package is None:
+                            subdirs = subdirectories(dirname)
+                except OSError:
+                    return ()
+            if package is None:
+                self._recordDir(dirname, subdirs)
+                return subdirs
+            found[dirname] = package
+            return ()
+
+        walk(top, visit, jobs)
+
+        # Sorted, so that duplicate package names are resolved the same
+        # way every time, no matter which thread found them first.
+        packages = {}
+        for dirname in sorted(found.keys()):
+            package = found[dirname]
+            packages[package.package] = package
+
+        if self.dirs != old_dirs or self.packages != old_packages:
+            self.save()
+        return packages
+
+    def _count(self, hit):
+        self._lock.acquire()
+        try:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        finally:
+            self._lock.release()
+
+    def _cachedPackage(self, dirname, cached, catalog):
+        "Returns the package at dirname if the cached entry is still valid"
+        if cached is None:
+            return None
+        dirsig, control, controlsig, location, fields = cached
+        if signature(dirname) != dirsig or signature(control) != controlsig:
+            return None
+        self._count(True)
+        self.packages[dirname] = cached
+        return Package.fromIndex(location, control, fields, catalog)
+
+    def _parsePackage(self, dirname, control, catalog):
+        "Parses the package at dirname and records it; None if it isn't one"
+        try:
+            package = Package(dirname, catalog, control=control)
+        except NotPackageError:
+            return None
+        self._count(False)
+        self.packages[dirname] = (signature(dirname),
+                                  control,
+                                  signature(control),
+                                  unicode(package.package_location),
+                                  package.toIndex())
+        return package
+
+    def _cachedDir(self, dirname, cached):
+        """Returns the cached sub-directories of a non-package dirname
+
+        Returns None if dirname wasn't a plain directory last time or it
+        has changed since.
+        """
+        if cached is None:
+            return None
+        sig, ctlsig, subdirs = cached
+        if signature(dirname) != sig or \
+           signature(os.path.join(dirname, CONTROLDIR)) != ctlsig:
+            return None
+        self._count(True)
+        self.dirs[dirname] = cached
+        return subdirs
+
+    def _recordDir(self, dirname, subdirs):
+        "Records the sub-directories of the non-package dirname"
+        self._count(False)
+        self.dirs[dirname] = (signature(dirname),
+                              signature(os.path.join(dirname, CONTROLDIR)),
+                              subdirs)
+
+if __name__ == "__main__":
+    import unittest, tempfile, shutil, time
+
+    class CatalogIndexTestCase(unittest.TestCase):
+
+        def setUp(self):
+            self.tmp = tempfile.mkdtemp()
+            self.top = os.path.join(self.tmp, 'packages')
+            self.filename = os.path.join(self.tmp, 'cache', 'catalog.index')
+            self.makePackage('one', 'one')
+            self.makePackage(os.path.join('group', 'two'), 'two', 'depends: one\n')
+
+        def tearDown(self):
+            shutil.rmtree(self.tmp, ignore_errors=True)
+
+        def makePackage(self, subdir, name, extra=''):
+            directory = os.path.join(self.top, subdir, CONTROLDIR)
+            os.makedirs(directory)
+            fp = file(os.path.join(directory, CONTROLFILENAME), 'w')
+            try:
+                fp.write("package: %s\ndescription: The %s package\n%s" % (name, name, extra))
+            finally:
+                fp.close()
+
+        def scan(self):
+            index = CatalogIndex(self.filename)
+            return index, index.scan(self.top, None, jobs=4)
+
+        def testColdThenWarm(self):
+            index, packages = self.scan()
+            self.assertEqual(['one', 'two'], sorted(packages.keys()))
+            self.assertEqual(0, index.hits)
+            self.assertTrue(os.path.isfile(self.filename))
+
+            index, packages = self.scan()
+            self.assertEqual(['one', 'two'], sorted(packages.keys()))
+            self.assertEqual(0, index.misses)
+            self.assertEqual(set(['one']), packages['two']._depends)
+
+        def testIncremental(self):
+            self.scan()
+            # Make sure the mtime really changes on coarse filesystems.
+            time.sleep(1.1)
+            self.makePackage(os.path.join('group', 'three'), 'three')
+            index, packages = self.scan()
+            self.assertEqual(['one', 'three', 'two'], sorted(packages.keys()))
+            # group changed and three is new; top, one and two are reused.
+            self.assertEqual(2, index.misses)
+
+    unittest.main()
+
+# vim: set sw=4 ts=4 expandtab
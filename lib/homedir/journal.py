@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+"""
+This is a package management system designed to work around packages
+for the homedirectory.  The code is based upon ideas from GNU Stow.
+
+HomeDir - manage the installation of packages for a user's homedir
+Copyright (C) 2004-2012 by Christian Höltje
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+"""
+
+import os, errno, tempfile
+from handle import warn, ensure_dir
+
+__all__ = ( 'Journal', 'JOURNAL_DIR', 'interrupted', 'recover' )
+
+# Where the journals live, relative to the destination directory.
+JOURNAL_DIR = os.path.join('.homedir', 'journal')
+JOURNAL_VERSION = 1
+
+def _field(value):
+    if value is None:
+        return ''
+    return unicode(value).encode('utf-8')
+
+def _value(field):
+    if field == '':
+        return None
+    return field.decode('utf-8')
+
+class Journal:
+    """What a plan is about to do to a destination, written before it's done.
+
+    All the operations are written first, then a line as each one is
+    applied.  The file is removed once the whole plan has been applied
+    and recorded in the manifests, so one that's left over means a run
+    was interrupted; recover() rolls it back or forward.
+
+    The file is plain text, one tab-separated entry per line:
+        op   <action> <path> <target> <previous kind> <previous text> <owner>
+        done <index of the op>
+    """
+
+    def __init__(self, filename, operations=(), done=()):
+        self.filename = filename
+        self.operations = list(operations)
+        self.done = set(done)
+        self._fp = None
+
+    def begin(cls, dest, operations):
+        "Classmethod: Writes a new journal of operations for dest"
+        directory = os.path.join(unicode(dest), JOURNAL_DIR)
+        ensure_dir(directory)
+        fd, filename = tempfile.mkstemp(prefix='%d-' % os.getpid(), dir=directory)
+        self = cls(filename, operations)
+        self._fp = os.fdopen(fd, 'w')
+        self._fp.write("# homedir journal %d\n" % JOURNAL_VERSION)
+        for operation in self.operations:
+            kind, text = operation.previous
+            self._fp.write("op\t%s\n" % "\t".join([
+                _field(operation.action), _field(operation.path),
+                _field(operation.target), _field(kind), _field(text),
+                _field(operation.owner)]))
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+        return self
+    begin = classmethod(begin)
+
+    def applied(self, index):
+        "Notes that operation index has been carried out"
+        self.done.add(index)
+        self._fp.write("done\t%d\n" % index)
+        self._fp.flush()
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+    def finish(self):
+        "Removes the journal; everything in it has been done and recorded"
+        self.close()
+        os.unlink(self.filename)
+
+    def load(cls, filename):
+        "Classmethod: Reads a journal left behind"
+        from plan import Operation
+        self = cls(filename)
+        fp = file(filename, 'r')
+        try:
+            header = fp.readline().split()
+            if header[-1:] != [str(JOURNAL_VERSION)]:
+                raise ValueError("%s has an unknown version" % filename)
+            for line in fp.readlines():
+                parts = line.rstrip('\n').split('\t')
+                if parts[0] == 'op' and len(parts) == 7:
+                    action, path, target, kind, text, owner = map(_value, parts[1:])
+                    self.operations.append(Operation(action, path, target,
+                                                     (kind, text), owner))
+                elif parts[0] == 'done' and len(parts) == 2:
+                    self.done.add(int(parts[1]))
+                # Anything else is a line cut short by the interruption.
+        finally:
+            fp.close()
+        return self
+    load = classmethod(load)
+
+def _running(pid):
+    if pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError, err:
+        return err.errno == errno.EPERM
+    return True
+
+def interrupted(dest):
+    "Returns the journals left in dest by runs that are no longer running"
+    directory = os.path.join(unicode(dest), JOURNAL_DIR)
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return []
+    journals = []
+    for name in names:
+        try:
+            pid = int(name.split('-', 1)[0])
+        except ValueError:
+            continue
+        filename = os.path.join(directory, name)
+        if not _running(pid):
+            journals.append((os.path.getmtime(filename), filename))
+    # Oldest first
+    journals.sort()
+    return [filename for mtime, filename in journals]
+
+def _inEffect(operation):
+    "Returns True if operation has (already) been carried out"
+    from plan import SYMLINK, REPLACE, UNLINK, MKDIR, RMDIR, RENAME
+    path, action = operation.path, operation.action
+    if action in (SYMLINK, REPLACE):
+        return os.path.islink(path) and os.readlink(path) == operation.target
+    elif action in (UNLINK, RMDIR):
+        return not os.path.lexists(path)
+    elif action == MKDIR:
+        return os.path.isdir(path) and not os.path.islink(path)
+    elif action == RENAME:
+        return os.path.lexists(operation.target) and not os.path.lexists(path)
+    return True
+
+def _inverse(operation):
+    "Returns the operation that undoes operation, or None if it can't be"
+    from plan import Operation, SYMLINK, REPLACE, UNLINK, MKDIR, RMDIR, \
+         RENAME, LINK, DIR
+    action, path, owner = operation.action, operation.path, operation.owner
+    kind, text = operation.previous
+    if action == SYMLINK:
+        return Operation(UNLINK, path, previous=(LINK, operation.target), owner=owner)
+    elif action == REPLACE and kind == LINK:
+        # Who owned the old link isn't known.
+        return Operation(REPLACE, path, text, (LINK, operation.target))
+    elif action == UNLINK and kind == LINK:
+        return Operation(SYMLINK, path, text, owner=owner)
+    elif action == MKDIR:
+        return Operation(RMDIR, path, previous=(DIR, None), owner=owner)
+    elif action == RMDIR:
+        return Operation(MKDIR, path, owner=owner)
+    elif action == RENAME:
+        return Operation(RENAME, operation.target, path, previous=operation.previous)
+    return None
+
+def recover(dest, rollback=False, manifests=None):
+    """Finishes (or, with rollback, undoes) the runs interrupted in dest
+
+    Only the operations in the journals are looked at.  Returns a list
+    of (journal filename, the number of operations carried out).
+    """
+    from dirfd import operations
+    from manifest import ManifestStore
+    if manifests is None:
+        manifests = ManifestStore(dest)
+    results = []
+    journals = interrupted(dest)
+    if rollback:
+        journals.reverse()
+    for filename in journals:
+        try:
+            journal = Journal.load(filename)
+        except (IOError, OSError, ValueError), err:
+            warn("Unable to read journal %s: %s" % (filename, err))
+            continue
+        if rollback:
+            todo = []
+            for index in range(len(journal.operations) - 1, -1, -1):
+                operation = journal.operations[index]
+                if index not in journal.done and not _inEffect(operation):
+                    continue
+                inverse = _inverse(operation)
+                if inverse is None:
+                    warn("Unable to undo: %s" % operation)
+                else:
+                    todo.append(inverse)
+        else:
+            todo = [operation for index, operation in enumerate(journal.operations)
+                    if index not in journal.done and not _inEffect(operation)]
+        fs = operations()
+        count = 0
+        try:
+            for operation in todo:
+                try:
+                    operation.apply(fs)
+                    count += 1
+                except OSError, err:
+                    warn("Unable to %s" % operation)
+        finally:
+            fs.close()
+        # Recording is idempotent, so it doesn't matter whether the
+        # interrupted run got as far as the manifests.
+        if rollback:
+            manifests.record(todo)
+        else:
+            manifests.record(journal.operations)
+        os.unlink(filename)
+        results.append((filename, count))
+    return results
+
+if __name__ == "__main__":
+    import unittest
+    from pathname import Pathname
+    from manifest import ManifestStore
+    from plan import Plan
+
+    class Interrupt(Exception): pass
+
+    class JournalTestCase(unittest.TestCase):
+
+        def setUp(self):
+            self.dest = Pathname(tempfile.mkdtemp()).realpath()
+            self.src = self.dest + 'src'
+            self.src.mkdir()
+            (self.src + 'file').open('w').close()
+            Pathname('src').symlink(self.dest + 'old')
+
+        def tearDown(self):
+            self.dest.rm_rf()
+
+        def interrupt(self, after):
+            "Applies a plan, but stops it after after operations"
+            plan = Plan(manifests=ManifestStore(self.dest))
+            plan.unlink(self.dest + 'old', owner='pkg')
+            plan.mkdir(self.dest + 'dir', owner='pkg')
+            plan.symlink('../src/file', self.dest + 'dir' + 'file', owner='pkg')
+            plan.symlink('src', self.dest + 'new', owner='pkg')
+            from plan import Operation
+            apply = Operation.apply
+            calls = []
+            def stopping(operation, fs=None):
+                if len(calls) == after:
+                    raise Interrupt()
+                calls.append(operation)
+                return apply(operation, fs)
+            Operation.apply = stopping
+            try:
+                self.assertRaises(Interrupt, plan.apply)
+            finally:
+                Operation.apply = apply
+            self.assertEqual(1, len(interrupted(self.dest)))
+
+        def names(self):
+            return sorted([unicode(name) for name in self.dest.listdir()])
+
+        def testCompletePlanLeavesNoJournal(self):
+            plan = Plan(manifests=ManifestStore(self.dest))
+            plan.symlink('src', self.dest + 'new', owner='pkg')
+            plan.apply()
+            self.assertEqual([], interrupted(self.dest))
+
+        def testFailedOperationLeavesNoJournal(self):
+            plan = Plan(manifests=ManifestStore(self.dest))
+            plan.symlink('src', self.dest + 'new', owner='pkg')
+            plan.unlink(self.dest + 'old', owner='pkg')
+            (self.dest + 'old').unlink()
+            self.assertRaises(OSError, plan.apply)
+            self.assertEqual([], interrupted(self.dest))
+            self.assertEqual(['new'], ManifestStore(self.dest).get('pkg').entries.keys())
+
+        def testRollForward(self):
+            self.interrupt(2)
+            self.assertEqual(2, recover(self.dest)[0][1])
+            self.assertEqual(['.homedir', 'dir', 'new', 'src'], self.names())
+            self.assertEqual([], interrupted(self.dest))
+            entries = ManifestStore(self.dest).get('pkg').entries
+            self.assertEqual(['dir', 'dir/file', 'new'], sorted(entries.keys()))
+
+        def testRollBack(self):
+            self.interrupt(3)
+            self.assertEqual(3, recover(self.dest, rollback=True)[0][1])
+            self.assertEqual(['.homedir', 'old', 'src'], self.names())
+            self.assertEqual(Pathname('src'), (self.dest + 'old').readlink())
+            self.assertEqual(['old'], ManifestStore(self.dest).get('pkg').entries.keys())
+
+    unittest.main()
+
+# vim: set sw=4 ts=4 expandtab
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""
+This is a package management system designed to work around packages
+for the homedirectory.  The code is based upon ideas from GNU Stow.
+
+HomeDir - manage the installation of packages for a user's homedir
+Copyright (C) 2004-2012 by Christian Höltje
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+"""
+
+import os, tempfile
+from handle import warn, ensure_dir
+
+__all__ = ( 'Manifest', 'ManifestStore', 'MANIFEST_DIR',
+            'SYMLINK', 'MKDIR' )
+
+# Where the manifests live, relative to the destination directory.
+MANIFEST_DIR = os.path.join('.homedir', 'installed')
+MANIFEST_VERSION = 1
+
+# Kinds of entries
+SYMLINK = 'symlink'
+MKDIR   = 'mkdir'
+
+class Manifest:
+    """What one package has put into a destination directory.
+
+    entries maps each path (relative to the destination) to a
+    (kind, link text) pair; the link text is None for directories.
+
+    The file is plain text, one tab-separated entry per line:
+        symlink <path> <link text>
+        mkdir   <path>
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        self.dirty = False
+        self.valid = False
+
+    def exists(self):
+        return self.valid
+
+    def load(self):
+        "Reads the manifest.  A missing or unreadable one is empty and not valid."
+        self.entries = {}
+        self.valid = False
+        if not os.path.isfile(self.filename):
+            return self
+        fp = file(self.filename, 'r')
+        try:
+            header = fp.readline().split()
+            if header[-1:] != [str(MANIFEST_VERSION)]:
+                warn("Ignoring manifest %s with an unknown version" % self.filename)
+                return self
+            for line in fp.readlines():
+                parts = line.rstrip('\n').split('\t')
+                if parts[0] == SYMLINK and len(parts) == 3:
+                    self.entries[parts[1]] = (SYMLINK, parts[2])
+                elif parts[0] == MKDIR and len(parts) == 2:
+                    self.entries[parts[1]] = (MKDIR, None)
+                else:
+                    warn("Ignoring manifest %s with a bad line: %r" % (self.filename, line))
+                    self.entries = {}
+                    return self
+        finally:
+            fp.close()
+        self.valid = True
+        return self
+
+    def save(self):
+        "Writes the manifest (atomically), removing it once it's empty."
+        if not self.dirty:
+            return
+        if not self.entries:
+            if os.path.exists(self.filename):
+                os.unlink(self.filename)
+            self.dirty = False
+            return
+        directory = os.path.dirname(self.filename)
+        ensure_dir(directory)
+        # A name of its own, as another thread may be saving it too.
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=directory)
+        fp = os.fdopen(fd, 'w')
+        try:
+            fp.write("# homedir manifest %d\n" % MANIFEST_VERSION)
+            for path in sorted(self.entries.keys()):
+                kind, text = self.entries[path]
+                if kind == SYMLINK:
+                    fp.write("%s\t%s\t%s\n" % (kind, path, text))
+                else:
+                    fp.write("%s\t%s\n" % (kind, path))
+        finally:
+            fp.close()
+        os.rename(tmp, self.filename)
+        self.dirty = False
+        self.valid = True
+
+    def add(self, path, kind, text=None):
+        self.entries[path] = (kind, text)
+        self.dirty = True
+
+    def discard(self, path):
+        if path in self.entries:
+            del self.entries[path]
+            self.dirty = True
+            return True
+        return False
+
+class ManifestStore:
+    "The manifests of every package installed into one destination directory."
+
+    def __init__(self, dest):
+        self.dest = os.path.realpath(unicode(dest))
+        self.directory = os.path.join(self.dest, MANIFEST_DIR)
+        self._manifests = {}
+        self._all_loaded = False
+
+    def relative(self, path):
+        "Returns path relative to the destination, or None if it's outside"
+        path = unicode(path)
+        if not path.startswith(self.dest + os.sep):
+            return None
+        return path[len(self.dest)+1:]
+
+    def absolute(self, relpath):
+        "Returns the absolute path of a path relative to the destination"
+        return os.path.join(self.dest, relpath)
+
+    def get(self, name):
+        "Returns the manifest for the package named name"
+        if name not in self._manifests:
+            self._manifests[name] = Manifest(os.path.join(self.directory, name)).load()
+        return self._manifests[name]
+
+    def installed(self):
+        "Returns the names of the packages with a manifest"
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        return [name for name in names if not name.endswith('.tmp')]
+
+    def _loadAll(self):
+        if not self._all_loaded:
+            for name in self.installed():
+                self.get(name)
+            self._all_loaded = True
+
+    def _forget(self, relpath, owner):
+        "Drops relpath from owner's manifest, or from whichever has it"
+        if owner is not None and self.get(owner).discard(relpath):
+            return
+        self._loadAll()
+        for manifest in self._manifests.values():
+            manifest.discard(relpath)
+
+    def record(self, operations):
+        "Updates the manifests from operations that have been applied"
+        # Avoid a circular import.
+        from plan import SYMLINK as DO_SYMLINK, MKDIR as DO_MKDIR, KEEP, \
+             UNLINK, RMDIR, RENAME, REPLACE
+        for operation in operations:
+            relpath = self.relative(operation.path)
+            if relpath is None:
+                continue
+            if operation.action == REPLACE:
+                # Only in a partly applied plan; whoever had it doesn't.
+                self._forget(relpath, None)
+            if operation.action in (DO_SYMLINK, KEEP, REPLACE) and operation.owner:
+                self.get(operation.owner).add(relpath, SYMLINK, operation.target)
+            elif operation.action == DO_MKDIR and operation.owner:
+                self.get(operation.owner).add(relpath, MKDIR)
+            elif operation.action in (UNLINK, RMDIR, RENAME):
+                self._forget(relpath, operation.owner)
+        self.save()
+
+    def forget(self, name):
+        "Drops the whole manifest for the package named name"
+        manifest = self.get(name)
+        if manifest.entries or manifest.exists():
+            manifest.entries = {}
+            manifest.dirty = True
+        self.save()
+
+    def save(self):
+        "Writes every manifest that has changed"
+        for manifest in self._manifests.values():
+            try:
+                manifest.save()
+            except (IOError, OSError), err:
+                warn("Unable to write manifest %s: %s" % (manifest.filename, err))
+
+if __name__ == "__main__":
+    import unittest, tempfile, shutil
+    from plan import Plan
+
+    class ManifestTestCase(unittest.TestCase):
+
+        def setUp(self):
+            self.dest = os.path.realpath(tempfile.mkdtemp())
+            os.mkdir(os.path.join(self.dest, 'src'))
+
+        def tearDown(self):
+            shutil.rmtree(self.dest)
+
+        def testRoundTrip(self):
+            manifest = Manifest(os.path.join(self.dest, 'm'))
+            manifest.add('.config', MKDIR)
+            manifest.add('.config/vim', SYMLINK, '../src/vim')
+            manifest.save()
+            loaded = Manifest(manifest.filename).load()
+            self.assertTrue(loaded.exists())
+            self.assertEqual(manifest.entries, loaded.entries)
+
+        def testConcurrentSaves(self):
+            import threading
+            filename = os.path.join(self.dest, MANIFEST_DIR, 'pkg')
+            errors = []
+            def save(count):
+                manifest = Manifest(filename)
+                for i in range(count):
+                    manifest.add('dir%d' % i, MKDIR)
+                try:
+                    for i in range(20):
+                        manifest.dirty = True
+                        manifest.save()
+                except EnvironmentError, err:
+                    errors.append(err)
+            threads = [threading.Thread(target=save, args=(count,))
+                       for count in range(1, 9)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual([], errors)
+            self.assertEqual(['pkg'], os.listdir(os.path.dirname(filename)))
+            entries = Manifest(filename).load().entries
+            self.assertEqual(entries, dict([('dir%d' % i, (MKDIR, None))
+                                            for i in range(len(entries))]))
+
+        def testPlanIsRecorded(self):
+            store = ManifestStore(self.dest)
+            link = os.path.join(self.dest, 'link')
+            plan = Plan(manifests=store)
+            plan.mkdir(os.path.join(self.dest, 'dir'), owner='pkg')
+            plan.symlink('src', link, owner='pkg')
+            plan.apply()
+            self.assertEqual(['pkg'], store.installed())
+            self.assertEqual({'dir': (MKDIR, None), 'link': (SYMLINK, 'src')},
+                             ManifestStore(self.dest).get('pkg').entries)
+
+            # Putting the same link back changes nothing on disk, but
+            # still says who it belongs to.
+            plan = Plan(manifests=ManifestStore(self.dest))
+            plan.unlink(link, owner='pkg')
+            plan.symlink('src', link, owner='other')
+            self.assertEqual(0, len(plan))
+            plan.apply()
+            store = ManifestStore(self.dest)
+            self.assertEqual({'dir': (MKDIR, None)}, store.get('pkg').entries)
+            self.assertEqual({'link': (SYMLINK, 'src')}, store.get('other').entries)
+
+            store.forget('pkg')
+            self.assertEqual(['other'], store.installed())
+
+    unittest.main()
+
+# vim: set sw=4 ts=4 expandtab
@@ -23,9 +23,14 @@ Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
 ## TODO: unmergeSubDir -- turn directories back to symlinks or delete.
 
-import os, sys, traceback
+import os, sys
 from handle import warn
-from pathname import Pathname
+from pathname import Pathname, StatCache, use_stat_cache, forget_stats
+from plan import Plan, CONFLICT
+from manifest import ManifestStore, SYMLINK as MANIFEST_SYMLINK
+from hooks import HookRunner, HookError
+from fingerprint import Fingerprint, FingerprintStore
+from timing import timed, begin, end
 
 __all__ = ('NotPackageError', 'ConflictError', 'Package',
            'CONTROLDIR', 'CONTROLFILENAME', 'OLD_CONTROLFILENAME', 'PKG_VERSION' )
@@ -35,6 +40,19 @@ CONTROLFILENAME = "control"
 OLD_CONTROLFILENAME = ".homedir.control"
 PKG_VERSION = 1
 IGNORE_DIRS=('.svn','CVS','RCS','.git')
+HOOKS=('pre-install','post-install','pre-remove','post-remove')
+
+def _cachingStats(func):
+    "Decorates a method to run with a StatCache of its own"
+    def wrapper(*args, **kwargs):
+        old = use_stat_cache(StatCache())
+        try:
+            return func(*args, **kwargs)
+        finally:
+            use_stat_cache(old)
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
 
 # Error Classes
 class NotPackageError(StandardError):
@@ -53,48 +71,89 @@ class ConflictError(StandardError):
         dst = self.dst
         return "The file %(dst)s prevents linking %(src)s" % locals()
 
+def _field(attr, doc):
+    "Returns a property for a control file attribute that's parsed on first use"
+    def fget(self):
+        return self._body().get(attr)
+    return property(fget, doc=doc)
+
 class Package(object):
     """HomeDir Package class.
 
+    Only the header of the control file (the package name, what it
+    depends on and the first line of the description) is read up front.
+    The rest, like dirs and mkdirs, is parsed the first time it's used.
     """
-    package = None
-    priority = None
-    maintainer = None
-    standards_version = None
-    description = None
-    dirs = None
-    mkdirs = None
-
-    package_location = None
-    src_dirs = None
-    src_mkdirs = None
+    __slots__ = ('catalog', 'package_location', 'control',
+                 'package', '_depends', '_summary',
+                 '_fields', '_src_dirs', '_src_mkdirs')
 
     conflict_resolver = None
+    hook_runner = HookRunner()
+    skip_unchanged_hooks = True
 
     _attributes = ('package','priority','maintainer','depends',
                    'standards-version','description','dirs','mkdirs',
                    'ubuntu-packages')
 
+    # The attributes needed to list packages and resolve dependencies.
+    _header = ('package', 'depends', 'description', 'standards-version')
+
     @apply
     def name():
         def fget(self):
             return self.package
         return property(**locals())
 
-    def __init__(self, directory, catalog):
+    priority          = _field('priority', "The package priority")
+    maintainer        = _field('maintainer', "Who maintains the package")
+    standards_version = _field('standards-version', "The control file version")
+    description       = _field('description', "The full description")
+    dirs              = _field('dirs', "Directories to merge instead of link")
+    mkdirs            = _field('mkdirs', "Directories to always create")
+
+    def __init__(self, directory, catalog, control=None):
         self.catalog = catalog
         self.package_location = directory = Pathname(directory).realpath()
-        self._depends = set()
-
-        # Find the control directory, supporting the old name.
-        control = directory + CONTROLDIR + CONTROLFILENAME
-        if not control.isfile():
-            control = directory + OLD_CONTROLFILENAME
 
-        if not control.isfile():
-            raise NotPackageError("No control file")
-
-        self._parse(control)
+        if control is not None:
+            # The caller has already found the control file.
+            control = Pathname(control)
+        else:
+            # Find the control directory, supporting the old name.
+            control = directory + CONTROLDIR + CONTROLFILENAME
+            if not control.isfile():
+                control = directory + OLD_CONTROLFILENAME
+
+            if not control.isfile():
+                raise NotPackageError("No control file")
+
+        self.control = control
+        self._fields = self._src_dirs = self._src_mkdirs = None
+        self._setHeader(self._parse(control, header_only=True))
+
+    def _setHeader(self, fields):
+        "Internal Method to set the header attributes"
+        self.package = fields.get('package')
+        self._depends = fields.get('depends', set())
+        self._summary = fields.get('description')
+
+    def toIndex(self):
+        "Returns the control file header for storing in a CatalogIndex"
+        return {'package':     self.package,
+                'depends':     self._depends,
+                'description': self._summary}
+
+    def fromIndex(cls, location, control, fields, catalog):
+        "Classmethod: Recreate a package from CatalogIndex data without parsing"
+        self = cls.__new__(cls)
+        self.catalog = catalog
+        self.package_location = Pathname(location)
+        self.control = Pathname(control)
+        self._fields = self._src_dirs = self._src_mkdirs = None
+        self._setHeader(fields)
+        return self
+    fromIndex = classmethod(fromIndex)
 
     def __repr__(self):
         return "<%s %s>" % (self.__class__.__name__,
@@ -115,7 +174,40 @@ class Package(object):
             return self.catalog.find(*self._depends)
         return property(**locals())
 
-    def _parse(self,control):
+    @apply
+    def src_dirs():
+        doc = "List of real locations for the dirs in src"
+        def fget(self):
+            if self._src_dirs is None:
+                self._src_dirs = [self.package_location + directory
+                                  for directory in self.dirs or ()]
+            return self._src_dirs
+        return property(**locals())
+
+    @apply
+    def src_mkdirs():
+        doc = "List of real locations of directories to make in src"
+        def fget(self):
+            if self._src_mkdirs is None:
+                self._src_mkdirs = [self.package_location + mkdir
+                                    for mkdir in self.mkdirs or ()]
+            return self._src_mkdirs
+        return property(**locals())
+
+    def _body(self):
+        "Returns all the control file attributes, parsing them on first use"
+        if self._fields is None:
+            self._fields = self._parse(self.control)
+        return self._fields
+
+    @timed('control', 'parse control')
+    def _parse(self, control, header_only=False):
+        """Parses the control file and returns a dictionary of attributes.
+
+        If header_only is set, only the _header attributes are kept and
+        the description is cut down to its first line.
+        """
+        fields = {}
         curr = None
         fp = file(unicode(control),'r')
         num = 0
@@ -132,7 +224,8 @@ class Package(object):
                 continue
             if curr and \
                ( line.startswith(' ') or line.startswith('\t') ):
-                self._attribute_append(curr,line,control,num)
+                if not header_only or curr == 'depends':
+                    self._attribute_append(fields,curr,line,control,num)
                 continue
 
             try:
@@ -152,69 +245,72 @@ class Package(object):
                 print >> sys.stderr, "Invalid attribute '%s' in control file:\n\t%s:%d" % (
                     attribute,control,num)
                 sys.exit(1)
-            self._attribute_set(attribute,value,control,num)
+            if not header_only or attribute in self._header:
+                self._attribute_set(fields,attribute,value,control,num)
             curr = attribute
 
+        if header_only:
+            return fields
+
         # Validate the mkdirs -- must be in dirs
-        if self.mkdirs and self.dirs:
-            for mkdir in self.mkdirs:
-                if mkdir not in self.dirs:
+        dirs = fields.get('dirs')
+        mkdirs = fields.get('mkdirs')
+        if mkdirs and dirs:
+            for mkdir in mkdirs:
+                if mkdir not in dirs:
                     print >> sys.stderr, \
                           "Invalid mkdir: '%s' isn't marked as a dir" % \
                           mkdir
                     sys.exit(1)
+        return fields
 
-        # List of real locations for the dirs in src
-        src_dirs = self.src_dirs = []
-        if self.dirs:
-            for directory in self.dirs:
-                src_dirs.append(self.package_location + directory)
-
-        # List of real locations of diretories to make in src
-        src_mkdirs = self.src_mkdirs = []
-        if self.mkdirs:
-            for mkdir in self.mkdirs:
-                src_mkdirs.append(self.package_location + mkdir)
-
-    def _attribute_set(self,attr,val,file,linenum):
+    def _attribute_set(self,fields,attr,val,file,linenum):
         "Internal Method to set an attribute"
         if attr in ('mkdirs','dirs'):
             if val.strip():
                 print >> sys.stderr, "%s start on the next line: %s:%d" % (
                     attr, file,linenum)
                 sys.exit(1)
-            setattr(self,attr, [])
+            fields[attr] = []
         elif attr == "depends":
-            self._depends = set([x.strip() for x in val.split(',') if x])
+            fields[attr] = set([x.strip() for x in val.split(',') if x])
         elif attr == 'standards-version':
             val = int(val)
             if val != PKG_VERSION:
                 raise NotPackageError("Invalid control file version: %s" % file)
-            self.standard_version = val
+            fields[attr] = val
         elif attr in self._attributes:
-            setattr( self, attr, val.strip() )
+            fields[attr] = val.strip()
         else:
             raise AssertionError("Invalid Attribute %s: %s:%d" % (attr,file,linenum))
 
-    def _attribute_append(self,attr,val,file,linenum):
+    def _attribute_append(self,fields,attr,val,file,linenum):
         "Internal Method to correct append to an attribute"
         if attr in ('mkdirs','dirs'):
-            getattr(self,attr).append(val.strip())
+            fields[attr].append(val.strip())
         elif attr == "depends":
-            self._depends.update(set([x.strip() for x in val.split(',')]))
+            fields[attr].update(set([x.strip() for x in val.split(',')]))
         elif attr == 'standards-version':
             raise AssertionError("Can't append %s" % attr)
         elif attr in self._attributes:
-            setattr(self, attr, getattr(self,attr) + '\n' + val.rstrip())
+            fields[attr] = fields[attr] + '\n' + val.rstrip()
         else:
             raise AssertionError("Invalid Attribute %s: %s:%d" % (attr,file,linenum))
 
-    def _resolveConflict(self,src,dst):
-        if self.conflict_resolver:
-            return self.conflict_resolver(src,dst)
+    def _resolveConflict(self,src,dst,plan):
+        if plan.dry_run:
+            plan.conflict(src,dst)
+            return False
+        elif self.conflict_resolver:
+            return self.conflict_resolver(src,dst,plan)
         else:
             raise ConflictError(src=src, dst=dst)
 
+    def _skipsConflict(self,dst,plan):
+        "Returns True if the conflict_resolver would leave dst alone without asking"
+        skips = getattr(self.conflict_resolver, 'skips', None)
+        return skips is not None and skips(dst, plan)
+
     def normalize(self, catalog):
         self.depends = catalog.find(*self.depends)
 
@@ -240,28 +336,29 @@ class Package(object):
         #print "  src-mkdirs:        %s"  % strify(self.src_mkdirs)
         print "  depends:           %s"  % strify(self.depends)
 
-    def unsymlink(self,file):
+    def unsymlink(self,file,plan,owner=None):
         "Helper method to remove a symlink and only symlinks"
         assert(isinstance(file,Pathname))
-        if file.islink():
-            file.unlink()
-        elif file.exists():
+        if owner is None:
+            owner = self.package
+        if plan.islink(file):
+            plan.unlink(file, owner=owner)
+        elif plan.exists(file):
             raise AssertionError("%s is not a symlink" % file)
         # else: It must not exist!
 
-    def symlink(self, src, dst):
+    def symlink(self, src, dst, plan):
         "Perform a relative symlink"
 
         assert(isinstance(src, Pathname))
         assert(isinstance(dst, Pathname))
-        src.relative_path_from(dst.dirname()).symlink(dst)
+        plan.symlink(src.relative_path_from(dst.dirname()), dst, owner=self.package)
 
     def short_description():
         doc = "Just the first line of the description"
         def fget(self):
-            desc = self.description
-            if desc:
-                return desc.split('\n')[0]
+            if self._summary:
+                return self._summary
             else:
                 return "No Description"
         fset = fdel = None
@@ -282,30 +379,46 @@ class Package(object):
     fromSubdir = classmethod(fromSubdir)
 
 
-    def merge(self,dest,src=None):
-        "Merge the package into dest"
+    def merge(self,dest,src=None,plan=None):
+        """Merge the package into dest
+
+        The changes are planned in plan.  If no plan is given, one is made
+        and applied once the whole merge has been worked out.
+        """
+        if plan is None:
+            span = begin('merge', "merge %s" % self.package, self.package)
+            try:
+                plan = Plan(manifests=ManifestStore(dest))
+                self.merge(dest,src,plan)
+                plan.apply()
+            finally:
+                end(span)
+            return
         ignore_control = src is None
         if src is None:
             src = self.package_location
         assert(isinstance(src, Pathname))
         assert(isinstance(dest, Pathname))
-        dest = dest.realpath()
-        for content in src.listdir():
+        if ignore_control:
+            # Only the top of the merge; below it dest is always real.
+            dest = plan.realpath(dest)
+        for entry in src.scandir():
+            content = entry.name
             if content in IGNORE_DIRS:
                 continue
             if ignore_control and (content == CONTROLDIR or content == OLD_CONTROLFILENAME):
                 continue
-            if (src + content).isdir():
-                self.mergeSubDir(src,dest,content)
+            if entry.is_dir():
+                self.mergeSubDir(src,dest,content,plan)
             else:
-                self.mergeNonDir(src,dest,content)
+                self.mergeNonDir(src,dest,content,plan)
 
     def isWithinLocation(self, path):
         "Returns true if path is within our package location"
         assert(isinstance(path, Pathname))
         return path.is_subdir_of(self.package_location)
 
-    def mergeSubDir(self,src,dest,content):
+    def mergeSubDir(self,src,dest,content,plan):
         "Merge the subdirectory content from src to dest"
         assert(isinstance(src, Pathname))
         assert(isinstance(dest, Pathname))
@@ -313,51 +426,55 @@ class Package(object):
         srcpath = src + content
         if srcpath not in self.src_dirs:
             return # We skip stuff not in directories
-        if srcpath in self.src_mkdirs and not destpath.exists():
-            destpath.mkdir()
-        if destpath.islink():
-            linkpath = destpath.realpath()
+        if srcpath in self.src_mkdirs and not plan.exists(destpath):
+            plan.mkdir(destpath, owner=self.package)
+        if plan.islink(destpath):
+            linkpath = plan.linktarget(destpath)
             if self.isWithinLocation(linkpath):
                 # This is fine.  The link is actually one of ours.
                 # Nuke it to make sure it's correct
-                self.unsymlink(destpath)
-                self.symlink(srcpath,destpath)
-            elif destpath.exists():
+                self.unsymlink(destpath,plan)
+                self.symlink(srcpath,destpath,plan)
+            elif plan.exists(destpath):
                 if linkpath == srcpath:
                     warn( "%s already points to %s" % (destpath,
                                                        srcpath) )
                     return
                 if srcpath.isdir():
-                    other = self.__class__.fromSubdir(linkpath, self.catalog)
+                    if self.catalog is not None:
+                        other = self.catalog.owner(linkpath)
+                    else:
+                        other = self.__class__.fromSubdir(linkpath, self.catalog)
                     if not other:
                         if self._resolveConflict(src=srcpath,
-                                                 dst=destpath):
+                                                 dst=destpath,
+                                                 plan=plan):
                             # Retry after the resolve
-                            self.mergeSubDir(src,dest,content)
+                            self.mergeSubDir(src,dest,content,plan)
                     else:
-                        self.unsymlink(destpath)
-                        destpath.mkdir()
-                        self.merge(src=srcpath,dest=destpath)
-                        other.merge(src=linkpath,dest=destpath)
+                        self.unsymlink(destpath,plan,owner=other.package)
+                        plan.mkdir(destpath, owner=self.package)
+                        self.merge(src=srcpath,dest=destpath,plan=plan)
+                        other.merge(src=linkpath,dest=destpath,plan=plan)
                 else:
                     raise AssertionError("Untested path")
-                    self._resolveConflict(src=srcpath, dst=destpath)
+                    self._resolveConflict(src=srcpath, dst=destpath, plan=plan)
             else:
-                if self._resolveConflict(src=srcpath, dst=destpath):
-                    self.unsymlink(destpath)
-                    self.symlink(srcpath,destpath)
-        elif destpath.exists():
-            if destpath.isdir():
-                self.merge(src=srcpath,dest=destpath)
+                if self._resolveConflict(src=srcpath, dst=destpath, plan=plan):
+                    self.unsymlink(destpath,plan)
+                    self.symlink(srcpath,destpath,plan)
+        elif plan.exists(destpath):
+            if plan.isdir(destpath):
+                self.merge(src=srcpath,dest=destpath,plan=plan)
             else:
-                if self._resolveConflict(src=srcpath, dst=destpath):
-                    self.symlink(srcpath,destpath)
+                if self._resolveConflict(src=srcpath, dst=destpath, plan=plan):
+                    self.symlink(srcpath,destpath,plan)
                 # else keep on trucking.
         else:
-            self.symlink(srcpath,destpath)
+            self.symlink(srcpath,destpath,plan)
 
 
-    def mergeNonDir(self, src, dest, content):
+    def mergeNonDir(self, src, dest, content, plan):
         assert(isinstance(src, Pathname))
         assert(isinstance(dest, Pathname))
 
@@ -367,35 +484,102 @@ class Package(object):
         # symlinks into
         destpath = dest + content
 
-        if destpath.islink():
-            linkpath = destpath.realpath()
-            if linkpath.exists():
+        if plan.islink(destpath):
+            linkpath = plan.linktarget(destpath)
+            if plan.exists(linkpath):
                 if self.isWithinLocation(linkpath):
                     warn( "%s already points to %s" % (destpath,
                                                        srcpath) )
+                    plan.keep(destpath, self.package)
                 else:
                     if self._resolveConflict(src=srcpath,
-                                             dst=destpath):
-                        self.symlink(srcpath,destpath)
+                                             dst=destpath,
+                                             plan=plan):
+                        self.symlink(srcpath,destpath,plan)
             else:
                 # It's a broken symlink and safe to nuke it (yes?)
-                self.unsymlink(destpath)
-                self.symlink(srcpath,destpath)
-        elif destpath.exists():
-            if self._resolveConflict(src=srcpath, dst=destpath):
-                self.symlink(srcpath,destpath)
+                self.unsymlink(destpath,plan)
+                self.symlink(srcpath,destpath,plan)
+        elif plan.exists(destpath):
+            if self._resolveConflict(src=srcpath, dst=destpath, plan=plan):
+                self.symlink(srcpath,destpath,plan)
             # otherwise, we're skipping the conflict
         else:
-            self.symlink(srcpath,destpath)
+            self.symlink(srcpath,destpath,plan)
+
+    def mergeEntry(self,dest,path,plan):
+        """Brings what path (in the package) installs in dest up to date,
+        without looking at the rest of the package.
 
-    def unmerge(self,dest,only_dirs=None):
-        "Unmerge the package from dest"
+        path may have just been added, removed or renamed.  Returns False
+        if path isn't something merge installs, e.g. it's in the control
+        directory.
+        """
+        assert(isinstance(dest, Pathname))
+        path = Pathname(path)
+        if not path.is_subdir_of(self.package_location):
+            return False
+        parts = path.relative_path_from(self.package_location)._split()[1]
+        if parts[0] in (CONTROLDIR, OLD_CONTROLFILENAME):
+            return False
+        for part in parts:
+            if part in IGNORE_DIRS:
+                return False
+
+        src = self.package_location
+        dest = top = plan.realpath(dest)
+        for part in parts[:-1]:
+            if src + part not in self.src_dirs:
+                return False # merge skips it
+            if not plan.isdir(dest + part) or plan.islink(dest + part):
+                # The whole directory is (or should be) a link, so that's
+                # what needs looking at.
+                self.mergeSubDir(src,dest,part,plan)
+                return True
+            src, dest = src + part, dest + part
+
+        name = parts[-1]
+        srcpath, destpath = src + name, dest + name
+        if srcpath.islink() or srcpath.exists():
+            if srcpath.isdir() and not srcpath.islink():
+                self.mergeSubDir(src,dest,name,plan)
+            elif not plan.islink(destpath) or \
+                 unicode(plan.linktarget(destpath)) != unicode(srcpath):
+                self.mergeNonDir(src,dest,name,plan)
+        elif plan.islink(destpath):
+            if self.isWithinLocation(plan.linktarget(destpath)):
+                self.unsymlink(destpath,plan)
+        elif plan.isdir(destpath) and srcpath in self.src_dirs:
+            only_dirs = [destpath] + [top + directory for directory in self.dirs or ()]
+            self.unmerge(destpath,only_dirs,plan)
+        return True
+
+    def unmerge(self,dest,only_dirs=None,plan=None):
+        """Unmerge the package from dest
+
+        As with merge, the changes are planned in plan, or in a plan of
+        its own that's applied at the end.
+        """
+        if plan is None:
+            span = begin('merge', "unmerge %s" % self.package, self.package)
+            try:
+                plan = Plan(manifests=ManifestStore(dest))
+                is_empty = self.unmerge(dest,only_dirs,plan)
+                plan.apply()
+                # Whatever is left behind isn't ours any more.
+                plan.manifests.forget(self.package)
+            finally:
+                end(span)
+            return is_empty
 
         assert(isinstance(dest,Pathname))
-        dest = dest.realpath()
 
         # We only check these dirs
         if only_dirs is None:
+            # Only the top of the unmerge; below it dest is always real.
+            dest = plan.realpath(dest)
+            if self.unmergeManifest(dest, plan):
+                return True
             only_dirs = [dest]
             if self.dirs:
                 for directory in self.dirs:
@@ -409,65 +593,219 @@ class Package(object):
             return False # It's not empty
 
         is_empty = True
-        for content in dest.listdir():
+        for content in plan.listdir(dest):
             destpath = dest + content
-            if destpath.islink():
-                linktarget = destpath.realpath()
+            if plan.islink(destpath):
+                linktarget = plan.linktarget(destpath)
                 if self.isWithinLocation(linktarget):
-                    self.unsymlink(destpath)
+                    self.unsymlink(destpath,plan)
                 else:
                     is_empty = False
-            elif destpath.isdir():
-                is_destpath_empty = self.unmerge(destpath, only_dirs)
+            elif plan.isdir(destpath):
+                is_destpath_empty = self.unmerge(destpath, only_dirs, plan)
                 is_empty = is_destpath_empty and is_empty
             else:
                 is_empty = False
 
         if is_empty:
-            try:
-                dest.rmdir()
-            except:
-                tb = traceback.format_exception( *sys.exc_info() )
-                print >> sys.stderr, "Unable to remove directory %s:\n %s" % (
-                    dest,tb[-1].rstrip())
+            # Failing to remove it is reported, but isn't fatal.
+            plan.rmdir(dest, owner=self.package)
 
         return is_empty
 
+    def unmergeManifest(self, dest, plan):
+        """Unmerge the package using what its manifest says it installed
+
+        Only the recorded symlinks are removed, along with any directory
+        the package made or lists in dirs that ends up empty.
+
+        Returns False, having planned nothing, if there's no manifest or
+        it doesn't match dest any more; unmerge then looks for the links.
+        """
+        if plan.manifests is None:
+            return False
+        manifest = plan.manifests.get(self.package)
+        if not manifest.exists():
+            return False
+
+        location = unicode(self.package_location) + os.sep
+        links = []
+        dirs = []
+        for relpath, (kind, text) in manifest.entries.items():
+            path = dest + relpath
+            if kind == MANIFEST_SYMLINK:
+                try:
+                    current = unicode(plan.readlink(path))
+                except OSError:
+                    current = None
+                target = os.path.normpath(os.path.join(unicode(path.dirname()), text))
+                if current != text or not target.startswith(location):
+                    warn("The manifest for %s is out of date" % self.package)
+                    return False
+                links.append(path)
+            else:
+                dirs.append(unicode(path))
+
+        for path in links:
+            self.unsymlink(path,plan)
+
+        # Only a directory we made, or took something out of, can have
+        # become empty.
+        touched = set(dirs)
+        for path in links:
+            touched.add(unicode(path.dirname()))
+        if self.dirs:
+            for directory in self.dirs:
+                dirs.append(unicode(dest + directory))
+        touched.discard(unicode(dest))
+
+        # Deepest first, so emptied parents can go too.
+        dirs = list(set(dirs))
+        dirs.sort(reverse=True)
+        for path in dirs:
+            if path in touched and plan.isempty(path):
+                touched.add(os.path.dirname(path))
+                touched.discard(unicode(dest))
+                plan.rmdir(Pathname(path), owner=self.package)
+        return True
+
+    def runHook(self,name,src=None,background=False,succeeded=None,dest=None):
+        """Runs the control script name (e.g. pre-install), if there is one
+
+        dest is where the package is being (un)installed; it's the
+        hook's $HOME.
+
+        A hook that fails raises HookError.  With background set, and a
+        hook_runner with more than one job, the hook is only started; it
+        runs once the hooks of the packages this one depends on are done.
+        succeeded, if given, is called once the hook has worked (or
+        straight away if there is no hook).
+        """
+        if src is None:
+            src = self.package_location
+        else:
+            src = Pathname(src)
+        hook = src + CONTROLDIR + name
+        runner = self.hook_runner
+        if not hook.access(os.X_OK):
+            hook = None
+        if background and runner.jobs > 1 and hook is not None:
+            runner.submit(self, name, str(hook), after=self.depends,
+                          succeeded=succeeded, dest=dest)
+            return
+        if background and runner.jobs > 1:
+            # Nothing to run, but keep the packages that depend on this
+            # one waiting for what it depends on.
+            runner.submit(self, name, None, after=self.depends, dest=dest)
+        elif hook is not None:
+            try:
+                result = runner.run(self, name, str(hook), after=self.depends,
+                                    dest=dest)
+            finally:
+                forget_stats() # Who knows what it did.
+            if not result.ok():
+                raise HookError(result)
+        if succeeded is not None:
+            succeeded()
+
+    def hasHooks(self,src=None):
+        "Returns True if the package (or src) has any hooks"
+        if src is None:
+            src = self.package_location
+        else:
+            src = Pathname(src)
+        for name in HOOKS:
+            if (src + CONTROLDIR + name).access(os.X_OK):
+                return True
+        return False
+
+    def fingerprint(self,src=None):
+        "Returns a Fingerprint of the package's files (or of src)"
+        if src is None:
+            src = self.package_location
+        return Fingerprint(src, IGNORE_DIRS)
+
+    def hooksUpToDate(self,fingerprints,src=None):
+        """Returns True if the package's files haven't changed since its
+        hooks last all worked, so there's no need to run them again.
+        """
+        if not self.skip_unchanged_hooks:
+            return False
+        return fingerprints.unchanged(self.package, self.fingerprint(src))
+
+    def hooksSucceeded(self,fingerprints,src=None):
+        "Records the package's files as the ones its hooks last worked on"
+        if self.hasHooks(src):
+            fingerprints.record(self.package, self.fingerprint(src))
+
+    @timed('package')
+    @_cachingStats
     def install(self,dest,src=None):
         "Install the package"
-        _src = src
-        if _src is None:
-            _src = self.package_location
-        else:
-            _src = Pathname(_src)
         dest = Pathname(dest)
-        preflight = _src + CONTROLDIR + 'pre-install'
-        if preflight.access(os.X_OK):
-            os.system(str(preflight))
-
+        fingerprints = FingerprintStore(dest)
+        if self.hooksUpToDate(fingerprints, src):
+            self.merge(dest,src)
+            return
+        self.runHook('pre-install', src, dest=dest)
         self.merge(dest,src)
+        self.runHook('post-install', src, background=True, dest=dest,
+                     succeeded=lambda: self.hooksSucceeded(fingerprints, src))
 
-        postflight = _src + CONTROLDIR + 'post-install'
-        if postflight.access(os.X_OK):
-            os.system(str(postflight))
-
+    @timed('package')
+    @_cachingStats
     def remove(self,dest,src=None):
         "Remove the package"
-        _src = src
-        if _src is None:
-            _src = self.package_location
-        else:
-            _src = Pathname(_src)
         dest = Pathname(dest)
+        self.runHook('pre-remove', src, dest=dest)
+        self.unmerge(dest)
+        FingerprintStore(dest).forget(self.package)
+        self.runHook('post-remove', src, dest=dest)
+
+    @timed('merge')
+    def planUpgrade(self,dest,plan):
+        """Plans upgrading the package in dest
+
+        What's installed is unmerged and the package is merged again in
+        the same plan, so the links that come out the same cancel out.
+        """
+        self.unmerge(dest, plan=plan)
+        self.merge(dest, plan=plan)
+
+    @timed('package')
+    @_cachingStats
+    def upgrade(self,dest):
+        """Upgrade the package in place
+
+        Only the links that differ from what's installed are added,
+        removed or changed.  The hooks are only run if the package's files
+        have changed since they last worked (see hooksUpToDate).  If
+        nothing differs, False is returned; a conflict the conflict_resolver
+        would just skip again doesn't count.
+        """
+        dest = Pathname(dest)
+        plan = Plan(dry_run=True, manifests=ManifestStore(dest))
+        self.planUpgrade(dest, plan)
+        fingerprints = FingerprintStore(dest)
+        hooks = not self.hooksUpToDate(fingerprints)
+        # A conflict that will only be skipped again doesn't change anything.
+        changes = [operation for operation in plan.compacted()
+                   if operation.action != CONFLICT or
+                   not self._skipsConflict(operation.path, plan)]
+        if not changes and not (hooks and fingerprints.get(self.package)):
+            return False
 
-        preflight = _src + CONTROLDIR + 'pre-remove'
-        if preflight.access(os.X_OK):
-            os.system(str(preflight))
-
-        self.unmerge(dest,src)
-
-        postflight = _src + CONTROLDIR + 'post-remove'
-        if postflight.access(os.X_OK):
-            os.system(str(postflight))
+        if hooks:
+            self.runHook('pre-remove', dest=dest)
+            self.runHook('pre-install', dest=dest)
+        # The hooks may have changed things; plan it again for real.
+        plan = Plan(manifests=ManifestStore(dest))
+        self.planUpgrade(dest, plan)
+        plan.apply()
+        if hooks:
+            self.runHook('post-remove', dest=dest)
+            self.runHook('post-install', background=True, dest=dest,
+                         succeeded=lambda: self.hooksSucceeded(fingerprints))
+        return True
 
 # vim: set sw=4 ts=4 expandtab
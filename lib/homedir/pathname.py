@@ -21,17 +21,212 @@ along with this program; if not, write to the Free Software
 Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 """
 
-import os, shutil
+import os, stat, shutil, threading
+
+# scandir gives us the file type from the directory listing itself
+# (d_type), saving an lstat per entry.  Fallback to listdir.
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+__all__ = ( 'Pathname', 'DirEntry', 'StatCache', 'use_stat_cache',
+            'forget_stats', 'lstat', 'readlink', 'temporary_name' )
+
+class StatCache:
+    """Remembers lstat, stat and readlink results for one operation.
+
+    Only lookups are cached; any change to the filesystem made through
+    Pathname throws the lot away (see forget_stats()).
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._lstat = {}
+        self._stat = {}
+        self._readlink = {}
+
+    def _lookup(self, cache, func, path):
+        try:
+            result = cache[path]
+        except KeyError:
+            try:
+                result = func(path)
+            except OSError, err:
+                result = err
+            cache[path] = result
+        if isinstance(result, OSError):
+            raise result
+        return result
+
+    def lstat(self, path):
+        st = self._lookup(self._lstat, os.lstat, path)
+        if not stat.S_ISLNK(st.st_mode):
+            # It's the same for stat when there's no link to follow.
+            self._stat[path] = st
+        return st
+
+    def stat(self, path):
+        return self._lookup(self._stat, os.stat, path)
 
-class Pathname:
+    def readlink(self, path):
+        return self._lookup(self._readlink, os.readlink, path)
+
+_local = threading.local()
+
+def use_stat_cache(cache):
+    """Sets the StatCache for the current thread; None turns caching off.
+
+    Returns the old one, so it can be put back afterwards.
+    """
+    old = getattr(_local, 'cache', None)
+    _local.cache = cache
+    return old
+
+def forget_stats():
+    "Empties the current thread's StatCache, if any.  Call after changing files."
+    cache = getattr(_local, 'cache', None)
+    if cache is not None:
+        cache.clear()
+
+def lstat(path):
+    "os.lstat(), through the current thread's StatCache"
+    cache = getattr(_local, 'cache', None)
+    if cache is None:
+        return os.lstat(path)
+    return cache.lstat(path)
+
+def _stat(path):
+    cache = getattr(_local, 'cache', None)
+    if cache is None:
+        return os.stat(path)
+    return cache.stat(path)
+
+def readlink(path):
+    "os.readlink(), through the current thread's StatCache"
+    cache = getattr(_local, 'cache', None)
+    if cache is None:
+        return os.readlink(path)
+    return cache.readlink(path)
+
+def temporary_name(path):
+    "Returns a name to make path under first, in the same directory"
+    directory, name = os.path.split(path)
+    return os.path.join(directory, ".%s.homedir-%d.tmp" % (name, os.getpid()))
+
+def _changes(func):
+    "Decorates a method that changes the filesystem"
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            forget_stats()
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+class DirEntry(object):
+    """Something in a directory, as found by Pathname.scandir().
+
+    name is its Pathname in the directory and path is its full Pathname.
+    The is_*() methods answer from the directory listing where the
+    platform gives file types there, and otherwise lstat it (through the
+    StatCache) the first time they're asked.
+    """
+    __slots__ = ('name', 'path', '_entry')
+
+    def __init__(self, directory, name, entry=None):
+        self.name = Pathname(name)
+        self.path = directory + self.name
+        self._entry = entry
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, self.path)
+
+    def is_symlink(self):
+        if self._entry is not None:
+            return self._entry.is_symlink()
+        return self.path.islink()
+
+    def is_dir(self, follow_symlinks=True):
+        if self._entry is not None:
+            return self._entry.is_dir(follow_symlinks=follow_symlinks)
+        if not follow_symlinks and self.path.islink():
+            return False
+        return self.path.isdir()
+
+    def is_file(self, follow_symlinks=True):
+        if self._entry is not None:
+            return self._entry.is_file(follow_symlinks=follow_symlinks)
+        if not follow_symlinks and self.path.islink():
+            return False
+        return self.path.isfile()
+
+    def lstat(self):
+        if self._entry is not None:
+            return self._entry.stat(follow_symlinks=False)
+        return self.path.lstat()
+
+# Path components are shared between Pathnames; intern() won't take unicode.
+_components = {}
+# (root, parts) of recently split paths.  They're mostly the same few
+# base directories over and over.
+_split_cache = {}
+SPLIT_CACHE_SIZE = 4096
+
+def _split(path):
+    """Returns (root, parts) for a path string.
+
+    root is os.sep for an absolute path and '' otherwise; parts is the
+    tuple of (interned) names in it, leaving out empty and '.' ones.
+    """
+    try:
+        return _split_cache[path]
+    except KeyError:
+        pass
+    if path.startswith(os.sep):
+        root = os.sep
+    else:
+        root = ''
+    parts = tuple([_components.setdefault(name, name)
+                   for name in path.split(os.sep)
+                   if name and name != os.curdir])
+    if len(_split_cache) >= SPLIT_CACHE_SIZE:
+        _split_cache.clear()
+    result = _split_cache[path] = (root, parts)
+    return result
+
+def _pathname(path, parts=None):
+    "Makes a Pathname from an already normalized path string"
+    new = object.__new__(Pathname)
+    new._path = path
+    new._parts = parts
+    return new
+
+class Pathname(object):
     """
     A class to wrap a filesystem path object. This makes working with lots of paths easier.
 
+    The path is kept as a normalized string; its components are split
+    out (once) when they're needed.
+
     Based on
     """
+    __slots__ = ('_path', '_parts')
+
     def __init__(self, *path):
+        if len(path) == 1 and isinstance(path[0], Pathname):
+            self._path = path[0]._path
+            self._parts = path[0]._parts
+            return
         path = [unicode(x) for x in path]
         self._path = os.path.normcase(unicode(os.path.join(*path)).rstrip(os.path.sep).rstrip(os.path.altsep))
+        self._parts = None
 
     def __str__(self):
         return self._path
@@ -40,16 +235,48 @@ class Pathname:
         return u'<%s id="%s" path="%s">' % (self.__class__.__name__, id(self), self._path)
 
     def __add__(self, other):
-        return Pathname(os.path.join(self._path, unicode(other)))
+        if isinstance(other, Pathname):
+            name, parts = other._path, other._parts
+        else:
+            name = os.path.normcase(unicode(other)).rstrip(os.path.sep).rstrip(os.path.altsep)
+            parts = None
+        if not self._path or not name or os.path.isabs(name):
+            return Pathname(os.path.join(self._path, name))
+        if self._parts is not None:
+            # Joining the parts is as good as splitting the result.
+            if parts is None:
+                parts = _split(name)
+            parts = (self._parts[0], self._parts[1] + parts[1])
+        return _pathname(self._path + os.sep + name, parts)
 
     def __eq__(self, other):
+        if isinstance(other, Pathname):
+            return self._path == other._path
         return self._path == os.path.normcase(unicode(other))
 
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        # The same as the path string's, since they compare equal.
+        return hash(self._path)
+
+    def _split(self):
+        "Returns (root, parts); see _split()"
+        if self._parts is None:
+            self._parts = _split(self._path)
+        return self._parts
+
     def basename(self):
         return Pathname(os.path.basename(self._path))
 
     def dirname(self):
-        return Pathname(os.path.dirname(self._path))
+        head, tail = os.path.split(self._path)
+        if self._parts is not None and tail and tail != os.curdir and \
+           head and not head.endswith(os.sep):
+            # It's just the last part gone.
+            return _pathname(head, (self._parts[0], self._parts[1][:-1]))
+        return Pathname(head)
 
     def realpath(self):
         return Pathname(os.path.realpath(self._path))
@@ -64,17 +291,36 @@ class Pathname:
                             self._path
                             )))))
 
+    def _mode(self, follow=True):
+        "Returns the st_mode, or None if there's nothing there"
+        try:
+            if follow:
+                return _stat(self._path).st_mode
+            else:
+                return lstat(self._path).st_mode
+        except OSError:
+            return None
+
+    def lstat(self):
+        return lstat(self._path)
+
+    def stat(self):
+        return _stat(self._path)
+
     def exists(self):
-        return os.path.exists(self._path)
+        return self._mode() is not None
 
     def isfile(self):
-        return os.path.isfile(self._path)
+        mode = self._mode()
+        return mode is not None and stat.S_ISREG(mode)
 
     def isdir(self):
-        return os.path.isdir(self._path)
+        mode = self._mode()
+        return mode is not None and stat.S_ISDIR(mode)
 
     def islink(self):
-        return os.path.islink(self._path)
+        mode = self._mode(follow=False)
+        return mode is not None and stat.S_ISLNK(mode)
 
     def isabs(self):
         return os.path.isabs(self._path)
@@ -85,32 +331,62 @@ class Pathname:
     def listdir(self):
         return tuple([Pathname(x) for x in os.listdir(self._path)])
 
+    def scandir(self):
+        "Like listdir(), but returns DirEntry objects that know their type"
+        if scandir is None:
+            return tuple([DirEntry(self, x) for x in os.listdir(self._path)])
+        return tuple([DirEntry(self, x.name, x) for x in scandir(self._path)])
+
     def readlink(self):
-        return Pathname(os.readlink(self._path))
+        return Pathname(readlink(self._path))
 
+    @_changes
     def mkdir(self):
         return os.mkdir(self._path)
 
+    @_changes
     def rmdir(self):
         return os.rmdir(self._path)
 
+    @_changes
     def rm_rf(self, ignore_errors=False):
         return shutil.rmtree(self._path, ignore_errors)
 
+    @_changes
     def unlink(self):
         return os.unlink(self._path)
 
-    def open(self, *args, **kwargs):
-        return file(self._path, *args, **kwargs)
+    def open(self, mode='r', *args, **kwargs):
+        if mode[:1] != 'r' or '+' in mode:
+            forget_stats()
+        return file(self._path, mode, *args, **kwargs)
 
+    @_changes
     def symlink(self, dest):
         "Symlink the current Pathname to the dest."
         return os.symlink(self._path, unicode(dest))
 
+    @_changes
+    def relink(self, dest):
+        """Symlink the current Pathname to the dest, replacing what's there.
+
+        The link is made under a temporary name next to dest and renamed
+        over it, so dest is never missing.  dest can't be a directory.
+        """
+        dest = unicode(dest)
+        tmp = temporary_name(dest)
+        os.symlink(self._path, tmp)
+        try:
+            os.rename(tmp, dest)
+        except:
+            os.unlink(tmp)
+            raise
+
     def split(self):
         head, tail = os.path.split(self._path)
         return (Pathname(head), Pathname(tail))
 
+    @_changes
     def rename(self, dest):
         return os.rename(self._path, unicode(dest))
 
@@ -124,77 +400,41 @@ class Pathname:
         "Algorithm taken from pathname.rb from Ruby 1.9.2"
         base = Pathname(base)
 
-        if self.isabs() and base.isabs():
-            is_rel = False
-        elif not self.isabs() and not base.isabs():
-            is_rel = True
-        else:
+        if self.isabs() != base.isabs():
             raise ValueError("self and base must both be relative or absolute!")
 
-        a_prefix = self._path
-        a_names = []
-
-        b_prefix = base._path
-        b_names = []
-
-        a_prefix, basename = os.path.split(a_prefix)
-        while a_prefix != '' and basename != '':
-            if basename != os.path.curdir:
-                a_names.insert(0, basename)
-            a_prefix, basename = os.path.split(a_prefix)
-
-        b_prefix, basename = os.path.split(b_prefix)
-        while b_prefix != '' and basename != '':
-            if basename != os.path.curdir:
-                b_names.insert(0, basename)
-            b_prefix, basename = os.path.split(b_prefix)
-
+        a_prefix, a_names = self._split()
+        b_prefix, b_names = base._split()
         if a_prefix != b_prefix:
-            raise "different prefix: %r and %r" % (a_prefix, b_prefix)
+            raise ValueError("different prefix: %r and %r" % (a_prefix, b_prefix))
 
-        while a_names and b_names and a_names[0] == b_names[0]:
-            a_names.pop(0)
-            b_names.pop(0)
+        common = 0
+        most = min(len(a_names), len(b_names))
+        while common < most and a_names[common] == b_names[common]:
+            common += 1
+        a_names = a_names[common:]
+        b_names = b_names[common:]
 
         if os.path.pardir in b_names:
             raise ValueError, "base includes .. in path: %r" % base
 
-        b_names = [os.path.pardir for x in b_names]
-        relpath = b_names + a_names
-
+        relpath = (os.path.pardir,) * len(b_names) + a_names
         if relpath:
-            return Pathname(*relpath)
+            return _pathname(os.sep.join(relpath), ('', relpath))
         else:
             return Pathname(os.path.curdir)
 
     def is_subdir_of(self, other):
-        "Returns true if other is a subdirectory of self."
+        "Returns true if self is inside (not the same as) the directory other."
         other = Pathname(other)
-
-        other_parts = []
-        other_prefix = other._path
-        self_parts  = []
-        self_prefix = self._path
-
-        other_prefix, basename = os.path.split(other_prefix)
-        while other_prefix != '' and basename != '':
-            if basename != os.path.curdir:
-                other_parts.insert(0, basename)
-            other_prefix, basename = os.path.split(other_prefix)
-
-        self_prefix, basename = os.path.split(self_prefix)
-        while self_prefix != '' and basename != '':
-            if basename != os.path.curdir:
-                self_parts.insert(0, basename)
-            self_prefix, basename = os.path.split(self_prefix)
+        self_prefix, self_parts = self._split()
+        other_prefix, other_parts = other._split()
 
         if other_prefix != self_prefix:
-            raise "different prefix: %r and %r" % (self_prefix, other_prefix)
-
-        other_path = os.path.sep.join(other_parts) + os.path.sep
-        self_path = os.path.sep.join(self_parts)
+            raise ValueError("different prefix: %r and %r" % (self_prefix, other_prefix))
 
-        return self_path.startswith(other_path)
+        depth = len(other_parts)
+        return len(self_parts) > depth and self_parts[:depth] == other_parts
 
 if __name__ == "__main__":
     import unittest, re, tempfile
@@ -265,6 +505,19 @@ if __name__ == "__main__":
             l = ('tmp', 'mouse', 'cat')
             for i in l:
                 self.assertTrue(Pathname(i) in l)
+            self.assertTrue(Pathname('tmp', 'fish') in set([Pathname('tmp') + 'fish']))
+            self.assertTrue(u'cat' in set([Pathname('cat')]))
+            self.assertFalse(Pathname('tmp') != 'tmp')
+
+        def testAddKeepsParts(self):
+            base = Pathname(os.path.sep, 'a', 'b')
+            base._split()
+            for name in ('c', Pathname('c', 'd'), 'c/./d/', os.path.sep + 'x', ''):
+                joined = base + name
+                self.assertEqual(Pathname(os.path.join(unicode(base), unicode(name))), joined)
+                self.assertEqual(_split(unicode(joined)), joined._split())
+                self.assertEqual(Pathname(os.path.dirname(unicode(joined))), joined.dirname())
+                self.assertEqual(_split(unicode(joined.dirname())), joined.dirname()._split())
 
         def testRelativePathFrom(self):
             s = os.path.sep
@@ -363,6 +616,43 @@ if __name__ == "__main__":
             finally:
                 d.rm_rf()
 
+        def testScandir(self):
+            d = Pathname(tempfile.mkdtemp())
+            try:
+                (d + 'dir').mkdir()
+                (d + 'dir').symlink(d + 'link')
+                (d + 'file').open('w').close()
+                entries = dict([(unicode(e.name), e) for e in d.scandir()])
+                self.assertEqual(['dir', 'file', 'link'], sorted(entries.keys()))
+                self.assertTrue (entries['dir'].is_dir())
+                self.assertFalse(entries['dir'].is_symlink())
+                self.assertTrue (entries['link'].is_dir())
+                self.assertFalse(entries['link'].is_dir(follow_symlinks=False))
+                self.assertTrue (entries['link'].is_symlink())
+                self.assertTrue (entries['file'].is_file())
+                self.assertEqual(d + 'file', entries['file'].path)
+            finally:
+                d.rm_rf()
+
+        def testStatCache(self):
+            d = Pathname(tempfile.mkdtemp())
+            old = use_stat_cache(StatCache())
+            try:
+                f = d + 'file'
+                self.assertFalse(f.exists())
+                os.mkdir(unicode(f)) # behind the cache's back
+                self.assertFalse(f.exists())
+                f.rmdir()
+                (d + 'dir').mkdir()
+                self.assertTrue((d + 'dir').isdir())
+                (d + 'dir').symlink(f)
+                self.assertTrue(f.islink())
+                self.assertTrue(f.isdir())
+                self.assertEqual(Pathname(d + 'dir'), f.readlink())
+            finally:
+                use_stat_cache(old)
+                d.rm_rf()
+
     unittest.main()
 # === Core methods
 #
@@ -0,0 +1,572 @@
+# -*- coding: utf-8 -*-
+"""
+This is a package management system designed to work around packages
+for the homedirectory.  The code is based upon ideas from GNU Stow.
+
+HomeDir - manage the installation of packages for a user's homedir
+Copyright (C) 2004-2012 by Christian Höltje
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+"""
+
+import os, sys, stat, traceback
+from pathname import Pathname, lstat, readlink
+from dirfd import operations, PathOperations
+from timing import timed
+from events import emit, emitting
+from journal import Journal
+from handle import warn
+
+__all__ = ( 'Plan', 'Operation',
+            'MKDIR', 'SYMLINK', 'UNLINK', 'RMDIR', 'RENAME', 'CONFLICT', 'KEEP',
+            'REPLACE' )
+
+# Operations
+MKDIR    = 'mkdir'
+SYMLINK  = 'symlink'
+UNLINK   = 'unlink'
+RMDIR    = 'rmdir'
+RENAME   = 'rename'
+CONFLICT = 'conflict'
+KEEP     = 'keep'
+REPLACE  = 'replace'
+
+# Kinds of filesystem entries
+DIR  = 'dir'
+FILE = 'file'
+LINK = 'link'
+ABSENT = (None, None)
+
+# Give up resolving symlinks after this many, like the kernel does.
+MAXLINKS = 40
+
+class Operation(object):
+    """One filesystem change.
+
+    path is what's changed.  target is the link text for SYMLINK, the
+    new name for RENAME and the source that wanted path for CONFLICT.
+    previous is what path was (kind, link text) before the change.
+    owner is the name of the package the change is made for, if any.
+
+    KEEP notes that an existing symlink already belongs to owner; it
+    doesn't change anything but is recorded in the manifests.
+
+    REPLACE makes path a symlink to target in place of the link or file
+    that's there, atomically.  compacted() makes them out of an UNLINK
+    followed by a SYMLINK of the same path.
+    """
+    __slots__ = ('action', 'path', 'target', 'previous', 'owner')
+
+    def __init__(self, action, path, target=None, previous=ABSENT, owner=None):
+        self.action = action
+        self.path = path
+        self.target = target
+        self.previous = previous
+        self.owner = owner
+
+    def __repr__(self):
+        return "<%s %s %s %s>" % (self.__class__.__name__,
+                                  self.action, self.path, self.target)
+
+    def __str__(self):
+        if self.action in (SYMLINK, REPLACE):
+            return "%-8s %s -> %s" % (self.action, self.path, self.target)
+        elif self.action == RENAME:
+            return "%-8s %s to %s" % (self.action, self.path, self.target)
+        elif self.action == CONFLICT:
+            return "%-8s %s is in the way of %s" % (self.action, self.path, self.target)
+        else:
+            return "%-8s %s" % (self.action, self.path)
+
+    def apply(self, fs=None):
+        """Does the operation
+
+        fs is what makes the changes (see dirfd.operations()); by default
+        they're made by path name.
+        """
+        if fs is None:
+            fs = PathOperations()
+        path = self.path
+        if self.action == MKDIR:
+            fs.mkdir(path)
+        elif self.action == SYMLINK:
+            fs.symlink(self.target, path)
+        elif self.action == REPLACE:
+            fs.relink(self.target, path)
+        elif self.action == UNLINK:
+            fs.unlink(path)
+        elif self.action == RENAME:
+            fs.rename(path, self.target)
+        elif self.action == RMDIR:
+            try:
+                fs.rmdir(path)
+            except:
+                tb = traceback.format_exception( *sys.exc_info() )
+                print >> sys.stderr, "Unable to remove directory %s:\n %s" % (
+                    path,tb[-1].rstrip())
+        elif self.action in (CONFLICT, KEEP):
+            pass # Nothing to do; it was only noted.
+        else:
+            raise AssertionError("Unknown operation %s" % self.action)
+
+class Plan:
+    """An ordered list of filesystem operations that haven't happened yet.
+
+    A Plan answers the usual questions (islink, exists, realpath,
+    listdir, ...) as if its operations had already been applied, so the
+    merge and unmerge code can decide everything up front.  apply() then
+    carries the operations out in one go.
+
+    If dry_run is set, conflicts are noted as CONFLICT operations instead
+    of being asked about.  If manifests (a ManifestStore) is given, it is
+    updated with what each package ends up owning once the plan is applied.
+    """
+
+    def __init__(self, dry_run=False, manifests=None):
+        self.dry_run = dry_run
+        self.manifests = manifests
+        self.operations = []
+        self._state = {}        # path -> (kind, link text) after the plan
+        self._children = {}     # dir -> names of planned entries in it
+        self._fresh = set()     # dirs made by the plan (no real contents)
+        self._shadows = set()   # planned paths that hide what's really below them
+        self._known = {}        # path -> (kind, None) of real entries seen by listdir
+        self._realdirs = set([os.sep]) # dirs with no symlinks in their path
+
+    def __len__(self):
+        return len(self.compacted())
+
+    ## Looking at the planned filesystem
+
+    def _lstat(self, path):
+        "Returns (kind, link text) for path, as it will be after the plan."
+        node = self._state.get(path)
+        if node is not None:
+            return node
+
+        # Is it inside something the plan has replaced?
+        if self._shadows:
+            parent = path
+            end = parent.rfind(os.sep)
+            while end > 0:
+                parent = parent[:end]
+                if parent in self._shadows:
+                    node = self._state[parent]
+                    if node[0] == LINK:
+                        return self._lstat(os.path.join(
+                            self._realpath(parent, 0), path[len(parent)+1:]))
+                    return ABSENT
+                end = parent.rfind(os.sep)
+
+        node = self._known.get(path)
+        if node is not None:
+            return node
+        try:
+            st = lstat(path)
+        except OSError:
+            return ABSENT
+        if stat.S_ISLNK(st.st_mode):
+            return (LINK, readlink(path))
+        elif stat.S_ISDIR(st.st_mode):
+            return (DIR, None)
+        else:
+            return (FILE, None)
+
+    def _realpath(self, path, depth):
+        resolved = os.sep
+        for part in os.path.abspath(path).split(os.sep):
+            if part in ('', os.curdir):
+                continue
+            if part == os.pardir:
+                resolved = os.path.dirname(resolved)
+                continue
+            candidate = os.path.join(resolved, part)
+            kind, text = self._lstat(candidate)
+            if kind == LINK and depth < MAXLINKS:
+                resolved = self._realpath(os.path.join(resolved, text), depth + 1)
+            else:
+                resolved = candidate
+        return resolved
+
+    def _follow(self, path):
+        "Returns the kind of path, following symlinks"
+        kind, text = self._lstat(unicode(path))
+        if kind == LINK:
+            kind, text = self._lstat(self._realpath(unicode(path), 0))
+            if kind == LINK:
+                return None # Too many links
+        return kind
+
+    def lexists(self, path):
+        return self._lstat(unicode(path))[0] is not None
+
+    def exists(self, path):
+        return self._follow(path) is not None
+
+    def isdir(self, path):
+        return self._follow(path) == DIR
+
+    def isfile(self, path):
+        return self._follow(path) == FILE
+
+    def islink(self, path):
+        return self._lstat(unicode(path))[0] == LINK
+
+    def readlink(self, path):
+        kind, text = self._lstat(unicode(path))
+        if kind != LINK:
+            raise OSError("Not a symlink: %s" % path)
+        return Pathname(text)
+
+    def realpath(self, path):
+        return Pathname(self._realpath(unicode(path), 0))
+
+    def _isreal(self, directory):
+        "Returns True if directory is a directory and none of its path is a symlink"
+        unknown = []
+        while directory not in self._realdirs:
+            unknown.append(directory)
+            directory = os.path.dirname(directory)
+        unknown.reverse()
+        for directory in unknown:
+            if self._lstat(directory)[0] != DIR:
+                return False
+            self._realdirs.add(directory)
+        return True
+
+    def linktarget(self, path):
+        """Returns where the symlink path leads, like realpath(path).
+
+        The link is read once and joined to its directory lexically.  The
+        directories involved are checked for symlinks only as far as one
+        already known to be free of them; if there is one, or the target
+        is another symlink, it's resolved in full instead.
+        """
+        path = unicode(path)
+        kind, text = self._lstat(path)
+        if kind == LINK:
+            directory = os.path.dirname(path)
+            target = os.path.normpath(os.path.join(directory, text))
+            if self._isreal(directory) and \
+               self._isreal(os.path.dirname(target)) and \
+               self._lstat(target)[0] != LINK:
+                return Pathname(target)
+        return Pathname(self._realpath(path, 0))
+
+    def listdir(self, path):
+        path = self._realpath(unicode(path), 0)
+        names = []
+        if path not in self._fresh and self._lstat(path)[0] == DIR:
+            try:
+                entries = Pathname(path).scandir()
+            except OSError:
+                entries = ()
+            for entry in entries:
+                name = unicode(entry.name)
+                names.append(name)
+                # Remember what it is, saving an lstat when it's asked
+                # about.  Symlinks still need reading.
+                if not entry.is_symlink():
+                    if entry.is_dir(follow_symlinks=False):
+                        self._known[os.path.join(path, name)] = (DIR, None)
+                    else:
+                        self._known[os.path.join(path, name)] = (FILE, None)
+        planned = self._children.get(path, ())
+        names = [name for name in names if name not in planned]
+        for name in planned:
+            if self._state[os.path.join(path, name)][0] is not None:
+                names.append(name)
+        return tuple([Pathname(name) for name in names])
+
+    def isempty(self, path):
+        "Returns True if path is a directory (not a symlink) with nothing in it"
+        path = unicode(path)
+        if self._lstat(path)[0] != DIR:
+            return False
+        path = self._realpath(path, 0)
+        planned = self._children.get(path, ())
+        for name in planned:
+            if self._state[os.path.join(path, name)][0] is not None:
+                return False
+        if path not in self._fresh:
+            try:
+                names = os.listdir(path)
+            except OSError:
+                names = []
+            for name in names:
+                if name not in planned:
+                    return False
+        return True
+
+    ## Planning changes
+
+    def _set(self, path, node, fresh=False):
+        "Sets what path will be after the plan"
+        if path in self._realdirs:
+            below = path + os.sep
+            self._realdirs = set([directory for directory in self._realdirs
+                                  if directory != path and not directory.startswith(below)])
+        self._state[path] = node
+        parent, name = os.path.split(path)
+        self._children.setdefault(parent, set()).add(name)
+        if fresh:
+            self._fresh.add(path)
+        else:
+            self._fresh.discard(path)
+        if fresh or node[0] != DIR:
+            self._shadows.add(path)
+        else:
+            self._shadows.discard(path)
+
+    def _record(self, action, path, target=None, node=ABSENT, owner=None):
+        path = unicode(path)
+        self.operations.append(Operation(action, path, target, self._lstat(path), owner))
+        if action not in (CONFLICT, KEEP):
+            self._set(path, node, fresh=(action == MKDIR))
+
+    def mkdir(self, path, owner=None):
+        self._record(MKDIR, path, node=(DIR, None), owner=owner)
+
+    def symlink(self, target, path, owner=None):
+        "Plans making path a symlink containing target"
+        target = unicode(target)
+        self._record(SYMLINK, path, target, node=(LINK, target), owner=owner)
+
+    def keep(self, path, owner):
+        "Notes that the existing symlink path belongs to owner"
+        kind, text = self._lstat(unicode(path))
+        self._record(KEEP, path, text, owner=owner)
+
+    def unlink(self, path, owner=None):
+        self._record(UNLINK, path, owner=owner)
+
+    def rmdir(self, path, owner=None):
+        self._record(RMDIR, path, owner=owner)
+
+    def rename(self, path, dest):
+        path, dest = unicode(path), unicode(dest)
+        node = self._lstat(path)
+        self._record(RENAME, path, dest)
+        self._set(dest, node)
+
+    def conflict(self, src, dst):
+        "Notes that dst is in the way of linking src"
+        self._record(CONFLICT, dst, unicode(src))
+
+    ## Doing it
+
+    def compacted(self):
+        """Returns the operations without the ones that cancel out.
+
+        Removing a symlink and then putting the same symlink back, or
+        removing a directory and then making it again, is left out.
+        Removing a link or file and then making a different symlink there
+        becomes one REPLACE, so the path is never missing.
+        """
+        dropped = set()
+        replaced = {}   # index of a SYMLINK -> the REPLACE done instead
+        pending = {}
+        for i, operation in enumerate(self.operations):
+            path = operation.path
+            undo = pending.pop(path, None)
+            if undo is not None:
+                previous = self.operations[undo].previous
+                if operation.action == SYMLINK and previous == (LINK, operation.target):
+                    dropped.update([undo, i])
+                    continue
+                if operation.action == MKDIR and previous[0] == DIR:
+                    dropped.update([undo, i])
+                    continue
+                if operation.action == SYMLINK and self.operations[undo].action == UNLINK:
+                    dropped.add(undo)
+                    replaced[i] = Operation(REPLACE, path, operation.target,
+                                            previous, operation.owner)
+                    continue
+            if operation.action in (UNLINK, RMDIR):
+                pending[path] = i
+            if operation.action == RENAME:
+                pending.pop(operation.target, None)
+        return [replaced.get(i, operation)
+                for i, operation in enumerate(self.operations)
+                if i not in dropped and operation.action != KEEP]
+
+    @timed('plan', 'apply plan')
+    def apply(self):
+        """Carries out the plan
+
+        With manifests, the operations are written to a journal first, so
+        that if this is interrupted it can be finished or undone later.
+        If an operation fails, the OSError is raised once the ones before
+        it have been recorded; there's nothing to recover then.
+        """
+        done = applied = []
+        failed = False
+        compacted = self.compacted()
+        journal = None
+        if self.manifests is not None and compacted:
+            try:
+                journal = Journal.begin(self.manifests.dest, compacted)
+            except (IOError, OSError), err:
+                warn("Unable to write a journal: %s" % err)
+        fs = operations()
+        try:
+            for index, operation in enumerate(compacted):
+                operation.apply(fs)
+                applied.append(operation)
+                if journal is not None:
+                    journal.applied(index)
+            # The full list says who owns what, even where the
+            # operations cancelled out on disk.
+            done = self.operations
+        except EnvironmentError:
+            failed = True
+            raise
+        finally:
+            fs.close()
+            if emitting():
+                self._emitCounts(applied)
+            if self.manifests is not None:
+                self.manifests.record(done)
+            if journal is not None:
+                if done is self.operations or failed:
+                    journal.finish()
+                else:
+                    journal.close()
+            self.operations = []
+            self._state = {}
+            self._children = {}
+            self._fresh = set()
+            self._shadows = set()
+            self._known = {}
+            self._realdirs = set([os.sep])
+
+    def _emitCounts(self, applied):
+        "Emits how many operations were applied for each package"
+        counts = {}
+        for operation in applied:
+            counts[operation.owner] = counts.get(operation.owner, 0) + 1
+        for owner, count in counts.items():
+            emit('operations', package=owner, count=count)
+
+    def describe(self):
+        "Returns a line of text for each operation"
+        return [unicode(operation) for operation in self.compacted()]
+
+if __name__ == "__main__":
+    import unittest, tempfile
+
+    class PlanTestCase(unittest.TestCase):
+
+        def setUp(self):
+            self.tmp = Pathname(tempfile.mkdtemp()).realpath()
+            self.src = self.tmp + 'src'
+            self.src.mkdir()
+            (self.src + 'file').open('w').close()
+
+        def tearDown(self):
+            self.tmp.rm_rf()
+
+        def testNothingHappensUntilApply(self):
+            plan = Plan()
+            dst = self.tmp + 'dir'
+            plan.mkdir(dst)
+            plan.symlink(self.src + 'file', dst + 'link')
+
+            self.assertFalse(dst.exists())
+            self.assertTrue(plan.isdir(dst))
+            self.assertTrue(plan.islink(dst + 'link'))
+            self.assertTrue(plan.exists(dst + 'link'))
+            self.assertEqual([Pathname('link')], list(plan.listdir(dst)))
+
+            plan.apply()
+            self.assertTrue(dst.isdir())
+            self.assertTrue((dst + 'link').islink())
+
+        def testVirtualLinksAreFollowed(self):
+            plan = Plan()
+            link = self.tmp + 'link'
+            plan.symlink(self.src, link)
+            self.assertEqual(self.src + 'file', plan.realpath(link + 'file'))
+            self.assertTrue(plan.isfile(link + 'file'))
+            self.assertEqual([Pathname('file')], list(plan.listdir(link)))
+
+        def testReplacedLinkIsEmptyDir(self):
+            link = self.tmp + 'link'
+            self.src.symlink(link)
+            plan = Plan()
+            plan.unlink(link)
+            plan.mkdir(link)
+            self.assertFalse(plan.islink(link))
+            self.assertEqual((), plan.listdir(link))
+            self.assertFalse(plan.exists(link + 'file'))
+
+        def testIsEmpty(self):
+            plan = Plan()
+            self.assertFalse(plan.isempty(self.src))
+            plan.unlink(self.src + 'file')
+            self.assertTrue(plan.isempty(self.src))
+            plan.symlink('src', self.tmp + 'link')
+            self.assertFalse(plan.isempty(self.tmp + 'link'))
+
+        def testLinkTarget(self):
+            plan = Plan()
+            link = self.tmp + 'link'
+            plan.symlink('src/file', link)
+            self.assertEqual(self.src + 'file', plan.linktarget(link))
+
+            # A symlink on the way is resolved in full.
+            plan.symlink('src', self.tmp + 'dir')
+            plan.symlink('dir/file', link)
+            self.assertEqual(self.src + 'file', plan.linktarget(link))
+
+            # And so is one made after the directory was seen to be real.
+            plan.unlink(self.tmp + 'dir')
+            plan.mkdir(self.tmp + 'dir')
+            self.assertEqual(self.tmp + 'dir' + 'file', plan.linktarget(link))
+            plan.rmdir(self.tmp + 'dir')
+            plan.symlink('src', self.tmp + 'dir')
+            self.assertEqual(self.src + 'file', plan.linktarget(link))
+
+        def testCompaction(self):
+            link = self.tmp + 'link'
+            self.src.symlink(link)
+            plan = Plan()
+            plan.unlink(link)
+            plan.symlink(self.src, link)
+            plan.unlink(self.tmp + 'other')
+            self.assertEqual(1, len(plan))
+            self.assertEqual(UNLINK, plan.compacted()[0].action)
+
+        def testReplace(self):
+            link = self.tmp + 'link'
+            self.src.symlink(link)
+            (self.tmp + 'file').open('w').close()
+            plan = Plan()
+            plan.unlink(link, owner='old')
+            plan.symlink('src/file', link, owner='new')
+            plan.unlink(self.tmp + 'file')
+            plan.symlink('src/file', self.tmp + 'file')
+            self.assertEqual([REPLACE, REPLACE],
+                             [operation.action for operation in plan.compacted()])
+            self.assertEqual('new', plan.compacted()[0].owner)
+            plan.apply()
+            self.assertEqual(Pathname('src/file'), link.readlink())
+            self.assertEqual(Pathname('src/file'), (self.tmp + 'file').readlink())
+            self.assertEqual(['file', 'link', 'src'],
+                             sorted([unicode(name) for name in self.tmp.listdir()]))
+
+    unittest.main()
+
+# vim: set sw=4 ts=4 expandtab
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+This is a package management system designed to work around packages
+for the homedirectory.  The code is based upon ideas from GNU Stow.
+
+HomeDir - manage the installation of packages for a user's homedir
+Copyright (C) 2004-2012 by Christian Höltje
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+"""
+
+import os, threading
+from fnmatch import fnmatchcase
+from pathname import Pathname
+from package import ConflictError
+from handle import warn
+
+__all__ = ( 'ConflictPolicy', 'PolicyError', 'parse_rule', 'POLICY_FILE',
+            'ACTIONS', 'ASK', 'BACKUP', 'OVERWRITE', 'SKIP', 'CANCEL' )
+
+POLICY_FILE = os.path.join('~', '.homedir', 'conflict-policy')
+
+# What to do with something that's in the way
+ASK       = 'ask'         # the user decides
+BACKUP    = 'backup'      # rename it to .bak (or .bak.1, ...)
+OVERWRITE = 'overwrite'   # remove it
+SKIP      = 'skip'        # leave it, and don't install that file
+CANCEL    = 'cancel'      # stop installing the package
+ACTIONS = (ASK, BACKUP, OVERWRITE, SKIP, CANCEL)
+
+class PolicyError(StandardError): pass
+
+def parse_rule(text):
+    "Parses ACTION:GLOB (as given on the command line) into (action, glob)"
+    action, sep, pattern = text.partition(':')
+    if not sep or not pattern:
+        raise PolicyError("A conflict rule looks like ACTION:GLOB, not %r" % text)
+    return _action(action), pattern
+
+def _action(action):
+    action = action.strip().lower()
+    if action not in ACTIONS:
+        raise PolicyError("Unknown conflict action %r; use one of %s" % (
+            action, ", ".join(ACTIONS)))
+    return action
+
+class ConflictPolicy:
+    """Decides what to do about conflicts without asking.
+
+    The rules are (action, glob) pairs, tried in order against the path
+    that's in the way, relative to the destination.  A glob without a /
+    also matches just the file name.  If no rule matches, the default is
+    used; ask, unless it's been set.
+
+    The file is one rule per line, with # comments:
+        default skip
+        backup  .bashrc
+        overwrite .config/*
+    """
+
+    def __init__(self, default=None):
+        self.default = default
+        self.rules = []
+        self.decisions = []     # (package, path, action, glob)
+        self._lock = threading.Lock()
+
+    def addRule(self, action, pattern):
+        self.rules.append((_action(action), pattern))
+
+    def load(self, filename):
+        "Adds the rules in filename; its default only counts if none is set"
+        fp = file(filename, 'r')
+        try:
+            lines = fp.readlines()
+        finally:
+            fp.close()
+        for linenum, line in enumerate(lines):
+            words = line.split('#', 1)[0].split(None, 1)
+            if not words:
+                continue
+            if len(words) != 2:
+                raise PolicyError("%s:%d: expected an action and a glob" % (
+                    filename, linenum + 1))
+            try:
+                if words[0] == 'default':
+                    if self.default is None:
+                        self.default = _action(words[1])
+                else:
+                    self.addRule(words[0], words[1].strip())
+            except PolicyError, err:
+                raise PolicyError("%s:%d: %s" % (filename, linenum + 1, err))
+
+    def decide(self, relpath):
+        "Returns (action, the glob that chose it or None) for relpath"
+        relpath = unicode(relpath)
+        name = os.path.basename(relpath)
+        for action, pattern in self.rules:
+            if fnmatchcase(relpath, pattern) or \
+               ('/' not in pattern and fnmatchcase(name, pattern)):
+                return action, pattern
+        return self.default or ASK, None
+
+    def resolve(self, action, src, dst, plan):
+        """Adds action on dst to plan.  Returns True if dst is out of the way
+
+        CANCEL raises ConflictError.  A real directory isn't removed to
+        overwrite it; it's backed up instead.
+        """
+        if action == CANCEL:
+            raise ConflictError(src=src, dst=dst)
+        elif action == SKIP:
+            return False
+        elif action == OVERWRITE:
+            if plan.isdir(dst) and not plan.islink(dst):
+                backup = self.backupName(dst, plan)
+                warn("%s is a directory; moving it to %s instead of overwriting it"
+                     % (dst, backup))
+                plan.rename(dst, backup)
+            elif plan.exists(dst) or plan.islink(dst):
+                plan.unlink(dst)
+            return True
+        elif action == BACKUP:
+            plan.rename(dst, self.backupName(dst, plan))
+            return True
+        raise ValueError("Can't resolve a conflict with %r" % action)
+
+    def backupName(self, dst, plan):
+        "Returns the first of dst.bak, dst.bak.1, ... that's free"
+        backup = Pathname("%s.bak" % dst)
+        count = 0
+        while plan.exists(backup) or plan.islink(backup):
+            count += 1
+            backup = Pathname("%s.bak.%d" % (dst, count))
+        return backup
+
+    def record(self, package, path, action, pattern=None):
+        "Remembers a decision, for summary()"
+        self._lock.acquire()
+        try:
+            self.decisions.append((package, unicode(path), action, pattern))
+        finally:
+            self._lock.release()
+
+    def summary(self):
+        "Returns {action: count} of the decisions made"
+        counts = {}
+        for package, path, action, pattern in self.decisions:
+            counts[action] = counts.get(action, 0) + 1
+        return counts
+
+if __name__ == "__main__":
+    import unittest, tempfile
+    from plan import Plan
+
+    class PolicyTestCase(unittest.TestCase):
+
+        def setUp(self):
+            self.tmp = Pathname(tempfile.mkdtemp()).realpath()
+
+        def tearDown(self):
+            self.tmp.rm_rf()
+
+        def testDecide(self):
+            policy = ConflictPolicy()
+            policy.addRule(BACKUP, '.bashrc')
+            policy.addRule(OVERWRITE, '.config/*')
+            self.assertEqual((BACKUP, '.bashrc'), policy.decide('.bashrc'))
+            self.assertEqual((BACKUP, '.bashrc'), policy.decide('sub/.bashrc'))
+            self.assertEqual((OVERWRITE, '.config/*'), policy.decide('.config/vim/rc'))
+            self.assertEqual((ASK, None), policy.decide('.vimrc'))
+            policy.default = SKIP
+            self.assertEqual((SKIP, None), policy.decide('.vimrc'))
+
+        def testLoad(self):
+            filename = unicode(self.tmp + 'policy')
+            fp = file(filename, 'w')
+            fp.write("# test\ndefault skip\n\nbackup .bashrc  # keep it\n")
+            fp.close()
+            policy = ConflictPolicy(default=CANCEL)
+            policy.load(filename)
+            self.assertEqual(CANCEL, policy.default)
+            self.assertEqual([(BACKUP, '.bashrc')], policy.rules)
+
+            fp = file(filename, 'w')
+            fp.write("shred .bashrc\n")
+            fp.close()
+            self.assertRaises(PolicyError, ConflictPolicy().load, filename)
+
+        def testParseRule(self):
+            self.assertEqual((SKIP, '*.local'), parse_rule('skip:*.local'))
+            self.assertRaises(PolicyError, parse_rule, 'skip')
+            self.assertRaises(PolicyError, parse_rule, 'later:x')
+
+        def testResolve(self):
+            dst = self.tmp + '.bashrc'
+            for path in (dst, self.tmp + '.bashrc.bak'):
+                file(unicode(path), 'w').close()
+            policy = ConflictPolicy()
+            plan = Plan()
+            self.assertTrue(policy.resolve(BACKUP, None, dst, plan))
+            plan.apply()
+            self.assertTrue((self.tmp + '.bashrc.bak.1').exists())
+            self.assertFalse(dst.exists())
+            self.assertRaises(ConflictError, policy.resolve, CANCEL, None, dst, plan)
+
+        def testOverwriteDirectory(self):
+            dst = self.tmp + '.gitconfig'
+            dst.mkdir()
+            file(unicode(dst + 'inside'), 'w').close()
+            plan = Plan()
+            self.assertTrue(ConflictPolicy().resolve(OVERWRITE, None, dst, plan))
+            plan.symlink('elsewhere', dst)
+            plan.apply()
+            self.assertTrue(dst.islink())
+            self.assertTrue((self.tmp + '.gitconfig.bak' + 'inside').exists())
+
+    unittest.main()
+
+# vim: set sw=4 ts=4 expandtab
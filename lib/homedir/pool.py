@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+This is a package management system designed to work around packages
+for the homedirectory.  The code is based upon ideas from GNU Stow.
+
+HomeDir - manage the installation of packages for a user's homedir
+Copyright (C) 2004-2012 by Christian Höltje
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+"""
+
+import sys, threading, Queue
+
+__all__ = ( 'parallel_map', )
+
+def parallel_map(func, items, jobs=1):
+    """Like map(func, items), but runs on up to jobs threads.
+
+    The results are returned in the same order as items.  If any call
+    raises, the first exception (in items order) is re-raised once all
+    the workers have finished.
+    """
+    items = list(items)
+    if jobs <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    results = [None] * len(items)
+    errors = [None] * len(items)
+    queue = Queue.Queue()
+    for pair in enumerate(items):
+        queue.put(pair)
+
+    def worker():
+        while True:
+            try:
+                i, item = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = func(item)
+            except:
+                errors[i] = sys.exc_info()
+
+    threads = [threading.Thread(target=worker) for i in range(min(jobs, len(items)))]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+    for thread in threads:
+        # A timeout keeps the main thread responsive to Ctrl-C.
+        while thread.isAlive():
+            thread.join(0.1)
+
+    for error in errors:
+        if error is not None:
+            raise error[0], error[1], error[2]
+    return results
+
+if __name__ == "__main__":
+    import unittest, time
+
+    class ParallelMapTestCase(unittest.TestCase):
+
+        def testOrder(self):
+            def slow(i):
+                time.sleep((10 - i) * 0.01)
+                return i * 2
+            self.assertEqual(range(0, 20, 2), parallel_map(slow, range(10), 4))
+
+        def testOneJob(self):
+            threads = []
+            def which(i):
+                threads.append(threading.currentThread())
+                return i
+            self.assertEqual(range(5), parallel_map(which, range(5)))
+            self.assertEqual([threading.currentThread()] * 5, threads)
+
+        def testFirstError(self):
+            done = []
+            def fail(i):
+                if i == 1:
+                    time.sleep(0.1)
+                    raise ValueError(i)
+                if i == 3:
+                    raise KeyError(i)
+                time.sleep(0.05)
+                done.append(i)
+                return i
+            try:
+                parallel_map(fail, range(6), 3)
+            except ValueError, err:
+                self.assertEqual((1,), err.args)
+            else:
+                self.fail("ValueError wasn't raised")
+            # Everything else still ran.
+            self.assertEqual([0, 2, 4, 5], sorted(done))
+
+    unittest.main()
+
+# vim: set sw=4 ts=4 expandtab
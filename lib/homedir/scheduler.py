@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+This is a package management system designed to work around packages
+for the homedirectory.  The code is based upon ideas from GNU Stow.
+
+HomeDir - manage the installation of packages for a user's homedir
+Copyright (C) 2004-2012 by Christian Höltje
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+"""
+
+from package import CONTROLDIR, OLD_CONTROLFILENAME, IGNORE_DIRS
+
+__all__ = ( 'schedule', 'destinations' )
+
+def destinations(package):
+    """Returns the names of the top-level entries package puts into dest.
+
+    Two packages that share none of these can be merged at the same time
+    without stepping on each other.
+    """
+    skip = set(IGNORE_DIRS + (CONTROLDIR, OLD_CONTROLFILENAME))
+    return set([unicode(name) for name in package.package_location.listdir()
+                if unicode(name) not in skip])
+
+def schedule(graph, packages, jobs=1, reverse=False):
+    """Splits packages into waves that can each be run concurrently.
+
+    The waves are in dependency order (see DependencyGraph.topologicalOrder,
+    which raises DependencyCycleError for cycles).  A package always comes
+    in a later wave than the packages it waits for, and two packages in the
+    same wave never share a top-level destination entry.
+
+    With one job, every wave is a single package.
+    """
+    ordered = graph.topologicalOrder(packages, reverse=reverse)
+    if jobs <= 1:
+        return [[package] for package in ordered]
+
+    if reverse:
+        waits_for = graph.rdepends
+    else:
+        waits_for = graph.depends
+    members = set(ordered)
+
+    # The level is the length of the longest chain to wait for.
+    levels = {}
+    by_level = []
+    for package in ordered:
+        level = 0
+        for other in waits_for.get(package, ()):
+            if other in members:
+                level = max(level, levels[other] + 1)
+        levels[package] = level
+        while len(by_level) <= level:
+            by_level.append([])
+        by_level[level].append(package)
+
+    waves = []
+    for level in by_level:
+        level_waves = []
+        for package in level:
+            claims = destinations(package)
+            for wave_claims, wave in level_waves:
+                if not claims & wave_claims:
+                    wave_claims.update(claims)
+                    wave.append(package)
+                    break
+            else:
+                level_waves.append((claims, [package]))
+        waves.extend([wave for wave_claims, wave in level_waves])
+    return waves
+
+if __name__ == "__main__":
+    import unittest, tempfile
+    from pathname import Pathname
+    from catalog import DependencyGraph
+
+    class ScheduleTestCase(unittest.TestCase):
+
+        class MockPackage:
+            def __init__(self, location, name, files, depends_on=()):
+                self.name = name
+                self.depends = list(depends_on)
+                self.package_location = location + name
+                self.package_location.mkdir()
+                (self.package_location + CONTROLDIR).mkdir()
+                for filename in files:
+                    (self.package_location + filename).open('w').close()
+            def __repr__(self):
+                return "<MockPackage name=%r>" % self.name
+
+        def setUp(self):
+            self.tmp = Pathname(tempfile.mkdtemp())
+            base = self.package('base', ['.profile'])
+            vim = self.package('vim', ['.vimrc', '.config'], [base])
+            emacs = self.package('emacs', ['.emacs', '.config'], [base])
+            git = self.package('git', ['.gitconfig'], [base])
+            tig = self.package('tig', ['.tigrc'], [git])
+            self.packages = [base, vim, emacs, git, tig]
+            self.graph = DependencyGraph(self.packages)
+
+        def tearDown(self):
+            self.tmp.rm_rf()
+
+        def package(self, name, files, depends_on=()):
+            return self.MockPackage(self.tmp, name, files, depends_on)
+
+        def names(self, waves):
+            return [[package.name for package in wave] for wave in waves]
+
+        def testOneJob(self):
+            waves = schedule(self.graph, self.packages, jobs=1)
+            self.assertEqual([['base'], ['emacs'], ['git'], ['tig'], ['vim']],
+                             self.names(waves))
+
+        def testWaves(self):
+            waves = schedule(self.graph, self.packages, jobs=4)
+            self.assertEqual([['base'], ['emacs', 'git'], ['vim'], ['tig']],
+                             self.names(waves))
+            wave_of = {}
+            for i, wave in enumerate(waves):
+                claimed = set()
+                for package in wave:
+                    wave_of[package] = i
+                    claims = destinations(package)
+                    self.assertFalse(claims & claimed)
+                    claimed.update(claims)
+            self.assertEqual(len(self.packages), len(wave_of))
+            for package in self.packages:
+                for other in package.depends:
+                    self.assertTrue(wave_of[other] < wave_of[package])
+
+        def testReverse(self):
+            waves = schedule(self.graph, self.packages, jobs=4, reverse=True)
+            self.assertEqual(['base'], self.names(waves)[-1])
+            wave_of = {}
+            for i, wave in enumerate(waves):
+                for package in wave:
+                    wave_of[package] = i
+            self.assertTrue(wave_of[self.packages[4]] < wave_of[self.packages[3]])
+
+        def testDestinations(self):
+            self.assertEqual(set(['.vimrc', '.config']),
+                             destinations(self.packages[1]))
+
+    unittest.main()
+
+# vim: set sw=4 ts=4 expandtab
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+This is a package management system designed to work around packages
+for the homedirectory.  The code is based upon ideas from GNU Stow.
+
+HomeDir - manage the installation of packages for a user's homedir
+Copyright (C) 2004-2012 by Christian Höltje
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+"""
+
+import os, threading
+from timeit import default_timer as timer
+try:
+    import json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        json = None
+
+__all__ = ( 'Profile', 'start_profile', 'stop_profile', 'begin', 'end', 'timed' )
+
+class Profile:
+    """Timed spans of a run, for the Chrome trace viewer (chrome://tracing)
+
+    Each span has a category (e.g. hook), a name and optionally the
+    package it was for.
+    """
+
+    def __init__(self):
+        self.start = timer()
+        self.spans = []         # (category, name, package, thread, start, end)
+        self.threads = {}       # thread id -> thread name
+        self._lock = threading.Lock()
+
+    def add(self, category, name, package, start, end):
+        thread = threading.currentThread()
+        tid = id(thread)
+        self._lock.acquire()
+        try:
+            self.threads[tid] = thread.getName()
+            self.spans.append((category, name, package, tid, start, end))
+        finally:
+            self._lock.release()
+
+    def events(self):
+        "Returns the spans as Chrome trace events"
+        pid = os.getpid()
+        events = []
+        for tid, name in self.threads.items():
+            events.append({'ph': 'M', 'name': 'thread_name', 'pid': pid,
+                           'tid': tid, 'args': {'name': name}})
+        for category, name, package, tid, start, end in self.spans:
+            event = {'ph': 'X', 'cat': category, 'name': name,
+                     'pid': pid, 'tid': tid,
+                     'ts': (start - self.start) * 1e6,
+                     'dur': (end - start) * 1e6}
+            if package is not None:
+                event['args'] = {'package': package}
+            events.append(event)
+        return events
+
+    def write(self, filename):
+        "Writes the Chrome trace-event JSON to filename"
+        fp = file(filename, 'w')
+        try:
+            json.dump({'traceEvents': self.events(),
+                       'displayTimeUnit': 'ms'}, fp)
+        finally:
+            fp.close()
+
+    def byPackage(self, *categories):
+        """Returns [(seconds, package)] for the spans in categories,
+        slowest first.
+
+        Time in spans nested in each other (in the same thread) is only
+        counted once.
+        """
+        totals = {}
+        covered = {}
+        for category, name, package, tid, start, end in sorted(
+            self.spans, key=lambda span: span[4]):
+            if package is None or category not in categories:
+                continue
+            key = (package, tid)
+            if covered.get(key, 0) >= end:
+                continue
+            covered[key] = end
+            totals[package] = totals.get(package, 0) + end - start
+        result = [(seconds, package) for package, seconds in totals.items()]
+        result.sort(reverse=True)
+        return result
+
+_profile = None
+
+def start_profile():
+    "Starts recording spans, returning the Profile they go into"
+    global _profile
+    _profile = Profile()
+    return _profile
+
+def stop_profile():
+    "Stops recording spans, returning the Profile they went into"
+    global _profile
+    profile, _profile = _profile, None
+    return profile
+
+def begin(category, name, package=None):
+    "Starts a span; pass what it returns to end().  Cheap when not profiling."
+    if _profile is None:
+        return None
+    return (category, name, package, timer())
+
+def end(span):
+    if span is not None and _profile is not None:
+        category, name, package, start = span
+        _profile.add(category, name, package, start, timer())
+
+def timed(category, name=None):
+    """Decorator: records each call as a span in category
+
+    The span is named name (or after the function) followed by the
+    package, if the call is a method of something with a package name.
+    """
+    def decorator(func):
+        label = name or func.__name__
+        def wrapper(*args, **kwargs):
+            if _profile is None:
+                return func(*args, **kwargs)
+            package = args and getattr(args[0], 'package', None)
+            if not isinstance(package, basestring):
+                package = None
+            span = begin(category, package and "%s %s" % (label, package) or label,
+                         package)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                end(span)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
+
+if __name__ == "__main__":
+    import unittest, tempfile
+
+    class Thing:
+        package = 'vim'
+        def work(self):
+            return 42
+        work = timed('package')(work)
+
+    class TimingTestCase(unittest.TestCase):
+
+        def tearDown(self):
+            stop_profile()
+
+        def testOffIsQuiet(self):
+            self.assertEqual(None, begin('x', 'y'))
+            self.assertEqual(42, Thing().work())
+
+        def testSpans(self):
+            profile = start_profile()
+            self.assertEqual(42, Thing().work())
+            end(begin('hook', 'post-install vim', 'vim'))
+            self.assertEqual(['work vim', 'post-install vim'],
+                             [span[1] for span in profile.spans])
+            self.assertEqual(['vim'], [package for seconds, package
+                                       in profile.byPackage('package', 'hook')])
+
+            if json is not None:
+                fd, filename = tempfile.mkstemp()
+                os.close(fd)
+                try:
+                    profile.write(filename)
+                    events = json.load(file(filename))['traceEvents']
+                finally:
+                    os.unlink(filename)
+                self.assertEqual(['M', 'X', 'X'], sorted([e['ph'] for e in events]))
+
+        def testNested(self):
+            profile = Profile()
+            profile.add('package', 'outer', 'vim', 0.0, 2.0)
+            profile.add('package', 'inner', 'vim', 0.5, 1.0)
+            profile.add('hook', 'post-install', 'vim', 2.0, 3.0)
+            self.assertEqual([(3.0, 'vim')], profile.byPackage('package', 'hook'))
+
+    unittest.main()
+
+# vim: set sw=4 ts=4 expandtab
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+This is a package management system designed to work around packages
+for the homedirectory.  The code is based upon ideas from GNU Stow.
+
+HomeDir - manage the installation of packages for a user's homedir
+Copyright (C) 2004-2012 by Christian Höltje
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+"""
+
+import os, errno, stat
+from manifest import ManifestStore, SYMLINK as MANIFEST_SYMLINK
+from package import CONTROLDIR, OLD_CONTROLFILENAME, IGNORE_DIRS
+from pool import parallel_map
+from timing import timed
+
+__all__ = ( 'Problem', 'Verifier', 'PROBLEMS',
+            'MISSING', 'BROKEN', 'FOREIGN', 'STALE' )
+
+# What can be wrong with a link
+MISSING = 'missing'     # it isn't there
+BROKEN  = 'broken'      # it leads nowhere
+FOREIGN = 'foreign'     # something else (or another package's link) is there
+STALE   = 'stale'       # it's left over from something the package no longer has
+PROBLEMS = (MISSING, BROKEN, FOREIGN, STALE)
+
+class Problem:
+    "Something wrong with what a package installed"
+
+    def __init__(self, package, kind, path, detail=None):
+        self.package = package
+        self.kind = kind
+        self.path = path
+        self.detail = detail
+
+    def __str__(self):
+        if self.detail:
+            return "%s %s (%s): %s" % (self.kind, self.path, self.package, self.detail)
+        return "%s %s (%s)" % (self.kind, self.path, self.package)
+
+def _lstat(path):
+    try:
+        return os.lstat(path)
+    except OSError, err:
+        if err.errno in (errno.ENOENT, errno.ENOTDIR):
+            return None
+        raise
+
+class Verifier:
+    """Checks that the packages installed in dest are as merge would
+    leave them, without changing anything.
+
+    The package trees are walked the way merge walks them, and what
+    each entry should have in dest is looked at: a link back to it, or
+    for a directory in dirs that's real in dest, what's in it.  The
+    links in each package's manifest that aren't wanted any more are
+    looked at too.  The packages are checked on up to jobs threads.
+    """
+
+    def __init__(self, catalog, dest, jobs=1):
+        self.catalog = catalog
+        self.dest = os.path.realpath(unicode(dest))
+        self.jobs = jobs
+        self.manifests = ManifestStore(self.dest)
+
+    def _checkLink(self, package, dstpath, srcpath, problems):
+        "Checks that dstpath is a link to srcpath"
+        try:
+            text = os.readlink(dstpath)
+        except OSError, err:
+            if err.errno in (errno.ENOENT, errno.ENOTDIR):
+                problems.append(Problem(package.package, MISSING, dstpath))
+            else:
+                problems.append(Problem(package.package, FOREIGN, dstpath,
+                                        "isn't a link"))
+            return
+        target = os.path.normpath(os.path.join(os.path.dirname(dstpath), text))
+        if target == srcpath:
+            return
+        if not os.path.exists(dstpath):
+            problems.append(Problem(package.package, BROKEN, dstpath,
+                                    "links to %s" % text))
+        elif os.path.realpath(dstpath) == os.path.realpath(srcpath):
+            return # By way of another link
+        else:
+            other = self.catalog.owner(target)
+            if other is None:
+                detail = "links to %s" % text
+            else:
+                detail = "belongs to %s" % other.package
+            problems.append(Problem(package.package, FOREIGN, dstpath, detail))
+
+    def expected(self, package, problems):
+        """Walks package and checks what it should have in dest
+
+        Returns the paths in dest that it should have.
+        """
+        location = unicode(package.package_location)
+        dirs = set([unicode(directory) for directory in package.src_dirs])
+        mkdirs = set([unicode(directory) for directory in package.src_mkdirs])
+        wanted = set()
+        pending = [(location, self.dest)]
+        while pending:
+            src, dst = pending.pop()
+            for name in os.listdir(src):
+                if name in IGNORE_DIRS:
+                    continue
+                if src == location and name in (CONTROLDIR, OLD_CONTROLFILENAME):
+                    continue
+                srcpath = os.path.join(src, name)
+                dstpath = os.path.join(dst, name)
+                if os.path.isdir(srcpath):
+                    if srcpath not in dirs:
+                        continue # merge skips it
+                    st = _lstat(dstpath)
+                    if st is not None and stat.S_ISDIR(st.st_mode):
+                        wanted.add(dstpath)
+                        pending.append((srcpath, dstpath))
+                        continue
+                    if st is None and srcpath in mkdirs:
+                        wanted.add(dstpath)
+                        problems.append(Problem(package.package, MISSING, dstpath,
+                                                "should be a directory"))
+                        continue
+                wanted.add(dstpath)
+                self._checkLink(package, dstpath, srcpath, problems)
+        return wanted
+
+    def stale(self, name, location, wanted, problems):
+        """Checks for links in name's manifest that aren't wanted but
+        still lead into location (or anywhere, if location is None)"""
+        manifest = self.manifests.get(name)
+        for relpath, (kind, text) in manifest.entries.items():
+            path = self.manifests.absolute(relpath)
+            if kind != MANIFEST_SYMLINK or path in wanted:
+                continue
+            try:
+                current = os.readlink(path)
+            except OSError:
+                continue # It's gone already
+            target = os.path.normpath(os.path.join(os.path.dirname(path), current))
+            if location is None:
+                problems.append(Problem(name, STALE, path,
+                                        "the package no longer exists"))
+            elif target.startswith(location + os.sep):
+                problems.append(Problem(name, STALE, path,
+                                        "the package no longer has %s" %
+                                        target[len(location)+1:]))
+
+    def check(self, name):
+        "Returns (the number of paths looked at, [Problem]) for package name"
+        problems = []
+        package = self.catalog.packages.get(name)
+        if package is None:
+            wanted = ()
+            location = None
+        else:
+            wanted = self.expected(package, problems)
+            location = unicode(package.package_location)
+        self.stale(name, location, wanted, problems)
+        return len(wanted), problems
+
+    @timed('verify', 'verify')
+    def run(self, names=None):
+        """Checks the packages named, or all those installed
+
+        Returns (the number of paths looked at, [Problem]).
+        """
+        if names is None:
+            names = self.manifests.installed()
+        names = sorted(names)
+        # Load the control files and manifests in this thread, so the
+        # workers only look.
+        for name in names:
+            package = self.catalog.packages.get(name)
+            if package is not None:
+                package.src_dirs, package.src_mkdirs
+            self.manifests.get(name)
+        count = 0
+        problems = []
+        for checked, found in parallel_map(self.check, names, self.jobs):
+            count += checked
+            problems.extend(found)
+        return count, problems
+
+if __name__ == "__main__":
+    import unittest, tempfile
+    from pathname import Pathname
+    from package import Package, CONTROLFILENAME
+
+    class MockCatalog:
+        def __init__(self, *packages):
+            self.packages = dict([(package.package, package) for package in packages])
+        def owner(self, path):
+            for package in self.packages.values():
+                if Pathname(path).is_subdir_of(package.package_location):
+                    return package
+            return None
+
+    class VerifyTestCase(unittest.TestCase):
+
+        def setUp(self):
+            self.tmp = Pathname(tempfile.mkdtemp()).realpath()
+            self.home = self.tmp + 'home'
+            self.home.mkdir()
+            self.packages = [self.package('one', ['.rc', '.profile', 'bin/tool']),
+                             self.package('two', ['.two'])]
+            for package in self.packages:
+                package.install(self.home)
+
+        def tearDown(self):
+            self.tmp.rm_rf()
+
+        def package(self, name, files):
+            location = self.tmp + name
+            location.mkdir()
+            (location + CONTROLDIR).mkdir()
+            fp = (location + CONTROLDIR + CONTROLFILENAME).open('w')
+            fp.write("package: %s\ndirs:\n  bin\nmkdirs:\n  bin\n" % name)
+            fp.close()
+            for filename in files:
+                path = location + filename
+                if not path.dirname().exists():
+                    path.dirname().mkdir()
+                path.open('w').close()
+            return Package(location, None)
+
+        def verify(self):
+            catalog = MockCatalog(*self.packages)
+            count, problems = Verifier(catalog, self.home, jobs=4).run()
+            return sorted([(p.kind, str(os.path.basename(p.path))) for p in problems])
+
+        def testClean(self):
+            self.assertEqual([], self.verify())
+
+        def testProblems(self):
+            one = self.packages[0].package_location
+            (self.home + '.rc').unlink()
+            (self.home + '.profile').unlink()
+            (self.home + '.profile').open('w').close()
+            (self.home + 'bin' + 'tool').unlink()
+            Pathname('../../two/.homedir/control').symlink(self.home + 'bin' + 'tool')
+            (one + '.gone').open('w').close()
+            Pathname('nowhere').symlink(self.home + '.gone')
+            (self.packages[1].package_location + '.two').rename(self.tmp + 'moved')
+            self.assertEqual([(BROKEN, '.gone'), (FOREIGN, '.profile'),
+                              (FOREIGN, 'tool'), (MISSING, '.rc'),
+                              (STALE, '.two')], self.verify())
+
+    unittest.main()
+
+# vim: set sw=4 ts=4 expandtab
@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+"""
+This is a package management system designed to work around packages
+for the homedirectory.  The code is based upon ideas from GNU Stow.
+
+HomeDir - manage the installation of packages for a user's homedir
+Copyright (C) 2004-2012 by Christian Höltje
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+"""
+
+import os, sys, stat, errno, select, struct, time
+try:
+    import ctypes, ctypes.util
+except ImportError:
+    ctypes = None
+from pathname import Pathname, StatCache, use_stat_cache
+from plan import Plan
+from manifest import ManifestStore
+from handle import warn
+from package import ConflictError, CONTROLDIR, CONTROLFILENAME, IGNORE_DIRS
+from events import emit
+from timing import begin, end
+
+__all__ = ( 'Inotify', 'Poller', 'new_watcher', 'Watch' )
+
+# How long things have to be quiet before a batch of changes is applied
+DELAY = 0.05
+# How often the Poller looks
+POLL_INTERVAL = 1.0
+
+# From <sys/inotify.h>
+IN_MOVED_FROM   = 0x00000040
+IN_MOVED_TO     = 0x00000080
+IN_CREATE       = 0x00000100
+IN_DELETE       = 0x00000200
+IN_DELETE_SELF  = 0x00000400
+IN_MOVE_SELF    = 0x00000800
+IN_Q_OVERFLOW   = 0x00004000
+IN_IGNORED      = 0x00008000
+IN_ONLYDIR      = 0x01000000
+IN_DONT_FOLLOW  = 0x02000000
+IN_ISDIR        = 0x40000000
+IN_NONBLOCK     = os.O_NONBLOCK
+IN_CLOEXEC      = 02000000
+WATCH_MASK = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | \
+             IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW
+EVENT = struct.Struct('iIII')
+
+_encoding = sys.getfilesystemencoding() or 'utf-8'
+
+def _walk(directory):
+    "Yields directory and the directories below it, skipping IGNORE_DIRS"
+    pending = [Pathname(directory)]
+    while pending:
+        directory = pending.pop()
+        yield directory
+        try:
+            entries = directory.scandir()
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.name not in IGNORE_DIRS and entry.is_dir(follow_symlinks=False):
+                pending.append(entry.path)
+
+class Inotify:
+    """Watches directory trees with Linux's inotify.
+
+    read() returns the paths that have been created, removed or moved
+    (in or out).  Editing a file doesn't change its link, so that isn't
+    looked for.  Directories that appear are watched
+    as well.  If the kernel's queue overflowed, read() returns None;
+    anything could have changed.
+    """
+
+    def __init__(self):
+        if ctypes is None or not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, "inotify isn't available")
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.watches = {}       # watch descriptor -> directory
+
+    def watch(self, directory):
+        "Watches directory and everything below it"
+        for directory in _walk(directory):
+            wd = self._add_watch(self.fd, unicode(directory).encode(_encoding),
+                                 WATCH_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err == errno.ENOSPC:
+                    raise OSError(err, "Too many directories to watch; "
+                                  "raise fs.inotify.max_user_watches")
+                # It's already gone again; its parent will say so.
+                continue
+            self.watches[wd] = directory
+
+    def read(self, timeout=None):
+        "Returns the paths that changed, waiting up to timeout seconds for some"
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError, err:
+            if err.errno == errno.EAGAIN:
+                return []
+            raise
+        paths = []
+        overflowed = False
+        offset = 0
+        while offset + EVENT.size <= len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                overflowed = True
+                continue
+            directory = self.watches.get(wd)
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if directory is None:
+                continue
+            if not name:
+                # The watched directory itself went; its parent reports it.
+                continue
+            path = directory + name.decode(_encoding)
+            paths.append(path)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) \
+               and name not in IGNORE_DIRS:
+                self.watch(path)
+        if overflowed:
+            return None
+        return paths
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+class Poller:
+    """Watches directory trees by looking at them every so often.
+
+    It's what's used where there's no inotify.  Like Inotify, read()
+    returns the paths that have been created or removed (or replaced by
+    something of another kind).
+    """
+
+    def __init__(self, interval=POLL_INTERVAL):
+        self.interval = interval
+        self.roots = []
+        self._seen = {}         # path -> its kind
+        self._last = time.time()
+
+    def _scan(self, root):
+        seen = {}
+        for directory in _walk(root):
+            try:
+                entries = directory.scandir()
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    st = entry.lstat()
+                except OSError:
+                    continue
+                seen[entry.path] = stat.S_IFMT(st.st_mode)
+        return seen
+
+    def watch(self, directory):
+        self.roots.append(Pathname(directory))
+        self._seen.update(self._scan(directory))
+
+    def read(self, timeout=None):
+        wait = self._last + self.interval - time.time()
+        if timeout is not None:
+            wait = min(wait, timeout)
+        if wait > 0:
+            time.sleep(wait)
+            if time.time() < self._last + self.interval:
+                return []
+        self._last = time.time()
+        seen = {}
+        for root in self.roots:
+            seen.update(self._scan(root))
+        paths = [path for path, info in seen.items()
+                 if self._seen.get(path) != info]
+        paths.extend([path for path in self._seen if path not in seen])
+        self._seen = seen
+        return paths
+
+    def close(self):
+        pass
+
+def new_watcher(poll=False):
+    "Returns an Inotify, or a Poller if there's no inotify (or poll is set)"
+    if not poll:
+        try:
+            return Inotify()
+        except (OSError, AttributeError), err:
+            warn("Looking for changes every %gs instead: %s" % (POLL_INTERVAL, err))
+    return Poller()
+
+class Watch:
+    """Keeps the packages installed in dests up to date as files are
+    added to them, removed from them and renamed.
+
+    The changes are gathered until things have been quiet for delay
+    seconds and then applied together.  Only what's under each changed
+    path is looked at (see Package.mergeEntry), unless the watcher lost
+    track, when every package is upgraded.
+    """
+
+    def __init__(self, catalog, packages, dests, watcher=None, delay=DELAY):
+        self.catalog = catalog
+        self.packages = set(packages)
+        self.dests = [Pathname(dest) for dest in dests]
+        self.watcher = watcher or new_watcher()
+        self.delay = delay
+
+    def start(self):
+        for package in self.packages:
+            self.watcher.watch(package.package_location)
+
+    def batch(self, timeout=None):
+        """Waits for changes and returns them, or None if the watcher lost
+        track.  Returns an empty list if there were none before timeout.
+        """
+        paths = self.watcher.read(timeout)
+        while paths:
+            more = self.watcher.read(self.delay)
+            if more is None:
+                return None
+            if not more:
+                break
+            paths.extend(more)
+        return paths
+
+    def group(self, paths):
+        """Returns {package: [paths]}, leaving out paths inside others and
+        those in packages that aren't watched."""
+        changes = {}
+        paths = list(set([unicode(path) for path in paths]))
+        paths.sort()
+        last = None
+        for path in paths:
+            if last is not None and path.startswith(last + os.sep):
+                continue
+            last = path
+            package = self.catalog.owner(path)
+            if package in self.packages:
+                changes.setdefault(package, []).append(Pathname(path))
+        return changes
+
+    def apply(self, paths):
+        """Applies the changes to paths to each dest
+
+        Returns [(dest, package, [operations as text])] for the packages
+        that changed something.
+        """
+        changed = []
+        changes = self.group(paths)
+        packages = changes.keys()
+        packages.sort()
+        old = use_stat_cache(StatCache())
+        span = begin('watch', 'apply changes')
+        try:
+            for dest in self.dests:
+                for package in packages:
+                    lines = self._applyOne(dest, package, changes[package])
+                    if lines:
+                        changed.append((dest, package, lines))
+        finally:
+            end(span)
+            use_stat_cache(old)
+        return changed
+
+    def _applyOne(self, dest, package, paths):
+        control = package.package_location + CONTROLDIR + CONTROLFILENAME
+        plan = Plan(manifests=ManifestStore(dest))
+        try:
+            for path in paths:
+                if path == control or path == control.dirname():
+                    warn("The control file of %s changed; run 'homedir upgrade %s'"
+                         % (package.package, package.package))
+                    continue
+                package.mergeEntry(dest, path, plan)
+        except ConflictError, err:
+            print >> sys.stderr, "%s" % err
+            return []
+        lines = plan.describe()
+        if lines:
+            plan.apply()
+            emit('watch', package=package.package, target=unicode(dest),
+                 operations=len(lines))
+        return lines
+
+    def rescan(self):
+        "Upgrades every package in each dest; returns like apply()"
+        changed = []
+        packages = list(self.packages)
+        packages.sort()
+        for dest in self.dests:
+            for package in packages:
+                plan = Plan(manifests=ManifestStore(dest))
+                try:
+                    package.planUpgrade(dest, plan)
+                except ConflictError, err:
+                    print >> sys.stderr, "%s" % err
+                    continue
+                lines = plan.describe()
+                if lines:
+                    plan.apply()
+                    changed.append((dest, package, lines))
+        return changed
+
+    def close(self):
+        self.watcher.close()
+
+if __name__ == "__main__":
+    import unittest, tempfile
+
+    class MockCatalog:
+        def __init__(self, package):
+            self.package = package
+        def owner(self, path):
+            if Pathname(path).is_subdir_of(self.package.package_location):
+                return self.package
+            return None
+
+    class WatchTestCase(unittest.TestCase):
+
+        def setUp(self):
+            from package import Package
+            self.tmp = Pathname(tempfile.mkdtemp()).realpath()
+            self.home = self.tmp + 'home'
+            self.home.mkdir()
+            location = self.tmp + 'pkg'
+            location.mkdir()
+            (location + CONTROLDIR).mkdir()
+            (location + 'bin').mkdir()
+            fp = (location + CONTROLDIR + CONTROLFILENAME).open('w')
+            fp.write("package: pkg\ndirs:\n  bin\nmkdirs:\n  bin\n")
+            fp.close()
+            (location + '.rc').open('w').close()
+            self.package = Package(location, None)
+            self.package.install(self.home)
+
+        def tearDown(self):
+            self.tmp.rm_rf()
+
+        def check(self, watcher):
+            watch = Watch(MockCatalog(self.package), [self.package], [self.home],
+                          watcher)
+            watch.start()
+            try:
+                location = self.package.package_location
+                (location + 'bin' + 'tool').open('w').close()
+                (location + '.rc').rename(location + '.rc2')
+                paths = watch.batch(5)
+                self.assertNotEqual([], paths)
+                changed = watch.apply(paths)
+                self.assertEqual(['.rc2', 'bin'], sorted([unicode(name) for name
+                                                          in self.home.listdir()])[1:])
+                self.assertTrue((self.home + 'bin' + 'tool').islink())
+                self.assertEqual(1, len(changed))
+            finally:
+                watch.close()
+
+        def testInotify(self):
+            try:
+                watcher = Inotify()
+            except OSError:
+                return
+            self.check(watcher)
+
+        def testPoller(self):
+            self.check(Poller(interval=0.1))
+
+    unittest.main()
+
+# vim: set sw=4 ts=4 expandtab